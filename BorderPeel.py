@@ -1,4 +1,9 @@
 from M3W import border_tools as bt
+from M3W.neighbors import AppendableNeighbors, RPForestNeighbors, save_neighbors, load_neighbors
+from M3W.profiling import Profiler
+import json
+import numpy as np
+import os
 from sklearn.base import BaseEstimator
 from sklearn.base import ClusterMixin
 
@@ -44,6 +49,14 @@ class BorderPeel(BaseEstimator, ClusterMixin):
                  , debug_marker_size=70
                  , core_points_threshold=1
                  , dvalue_threshold=1
+                 , core_merge_method="radius"
+                 , membership_format="dense"
+                 , out_of_core_dir=None
+                 , block_size=65536
+                 , n_jobs=None
+                 , backend="numpy"
+                 , neighbors_backend="exact"
+                 , profile=False
                  ):
         self.method = method
         self.k = k
@@ -61,6 +74,14 @@ class BorderPeel(BaseEstimator, ClusterMixin):
         self.debug_marker_size = debug_marker_size
         self.core_points_threshold = core_points_threshold
         self.dvalue_threshold = dvalue_threshold
+        self.core_merge_method = core_merge_method
+        self.membership_format = membership_format
+        self.out_of_core_dir = out_of_core_dir
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.neighbors_backend = neighbors_backend
+        self.profile = profile
 
         # out fields
         self.labels_ = None
@@ -71,57 +92,227 @@ class BorderPeel(BaseEstimator, ClusterMixin):
         self.associations = None
         self.link_thresholds = None
         self.border_values_per_iteration = None
+        self.peeling_ = None
+        self.profile_ = None
+        self.cores_ = None
+        self.absorber_ = None
 
-    def fit(self, X, X_plot_projection=None):
+    def fit(self, X, X_plot_projection=None, nbrs_cache=None):
         """Perform BorderPeel clustering from features
         Parameters
         ----------
         X : array of features (TODO: make it work with sparse arrays)
         X_projected : A projection of the data to 2D used for plotting the graph during the cluster process
+        nbrs_cache : A NeighborCache of X with at least 2 * k neighbors (e.g. the one used to estimate lambda),
+            reused instead of computing the neighbors of X again
+        """
+
+        self.fit_peeling(X, X_plot_projection=X_plot_projection, nbrs_cache=nbrs_cache)
+        return self.fit_assignment()
+
+    def fit_peeling(self, X, X_plot_projection=None, nbrs_cache=None):
+        """Runs the peeling and core merge stage of fit() and keeps its result as peeling_, the assignment
+        stage (fit_assignment) can then be run for several core_points_threshold, dvalue_threshold and
+        min_cluster_size settings (e.g. changed with set_params) without peeling again.
         """
 
         # density estimation
         if self.method == "exp_local_scaling":
-            border_func = lambda data: bt.rknn_with_distance_transform(data, self.k, bt.exp_local_scaling_transform)
+            border_func = lambda data, nbrs=None: bt.rknn_with_distance_transform(
+                data, self.k, bt.exp_local_scaling_transform, nbrs, n_jobs=self.n_jobs, backend=self.backend,
+                block_size=self.block_size
+            )
             # threshold_func = lambda value: value > self.threshold
 
-        result = bt.dynamic_3w(X
-                               , border_func
-                               , None
-                               , max_iterations=self.max_iterations
-                               , mean_border_eps=self.mean_border_eps
-                               , plot_debug_output_dir=self.plot_debug_output_dir
-                               , k=self.k
-                               , precentile=self.border_precentile
-                               , dist_threshold=self.dist_threshold
-                               , link_dist_expansion_factor=self.link_dist_expansion_factor
-                               , verbose=self.verbose
-                               , vis_data=X_plot_projection
-                               , min_cluster_size=self.min_cluster_size
-                               , stopping_precentile=self.stopping_precentile
-                               , should_merge_core_points=self.merge_core_points
-                               , debug_marker_size=self.debug_marker_size
-                               , core_points_threshold=self.core_points_threshold
-                               , dvalue_threshold=self.dvalue_threshold
-                               )
-
-        self.labels_, self.core_points, self.non_merged_core_points, \
-        self.data_sets_by_iterations, self.associations, self.link_thresholds, \
-        self.border_values_per_iteration, self.core_points_indices = result
+        # per stage timings of the run (see profiling.Profiler), kept as profile_
+        self.profile_ = Profiler() if self.profile else None
+
+        self.peeling_ = bt.peel_and_merge(X
+                                          , border_func
+                                          , None
+                                          , max_iterations=self.max_iterations
+                                          , mean_border_eps=self.mean_border_eps
+                                          , plot_debug_output_dir=self.plot_debug_output_dir
+                                          , k=self.k
+                                          , precentile=self.border_precentile
+                                          , dist_threshold=self.dist_threshold
+                                          , link_dist_expansion_factor=self.link_dist_expansion_factor
+                                          , verbose=self.verbose
+                                          , vis_data=X_plot_projection
+                                          , stopping_precentile=self.stopping_precentile
+                                          , should_merge_core_points=self.merge_core_points
+                                          , debug_marker_size=self.debug_marker_size
+                                          , core_merge_method=self.core_merge_method
+                                          , out_of_core_dir=self.out_of_core_dir
+                                          , block_size=self.block_size
+                                          , n_jobs=self.n_jobs
+                                          , backend=self.backend
+                                          , nbrs_cache=nbrs_cache
+                                          , neighbors_backend=self.neighbors_backend
+                                          , profiler=self.profile_
+                                          )
+
+        peeling = self.peeling_
+        self.core_points = peeling.core_points
+        self.non_merged_core_points = peeling.non_merged_core_points
+        self.data_sets_by_iterations = peeling.data_sets
+        self.associations = peeling.uf_map
+        self.link_thresholds = peeling.link_thresholds
+        self.border_values_per_iteration = peeling.border_values_per_iteration
+        self.core_points_indices = peeling.original_indices
 
         return self
 
-    def fit_predict(self, X, X_plot_projection=None):
+    def fit_assignment(self):
+        """Runs the three-way assignment stage of fit() on the result of fit_peeling() with the current
+        core_points_threshold, dvalue_threshold, min_cluster_size and membership_format.
+        """
+        self.absorber_ = None
+        self.labels_, self.cores_ = bt.three_way_assignment(self.peeling_
+                                               , min_cluster_size=self.min_cluster_size
+                                               , core_points_threshold=self.core_points_threshold
+                                               , dvalue_threshold=self.dvalue_threshold
+                                               , membership_format=self.membership_format
+                                               , n_jobs=self.n_jobs
+                                               , neighbors_backend=self.neighbors_backend
+                                               , profiler=self.profile_
+                                               , return_cores=True
+                                               , out_of_core_dir=self.out_of_core_dir
+                                               )
+        return self
+
+    def partial_fit(self, X):
+        """Adds a batch of points to the fitted model without peeling all the points again (the first batch is
+        fitted). The border values are only updated around the new points, the new points join the core points or
+        the border regions and the clusters are merged or created along the links of the new core points, see
+        border_tools.BatchAbsorber. The peeled/core status of the points of earlier batches is kept, so the result
+        approximates fit() on all the points. labels_ and cores_ cover all the points so far.
+        """
+        if self.cores_ is None:
+            return self.fit(X)
+        if self.absorber_ is None:
+            if self.peeling_ is None:
+                raise ValueError("partial_fit() needs the peeling of fit(), a loaded model can only predict()")
+            self.absorber_ = bt.BatchAbsorber(self.peeling_
+                                              , self.cores_
+                                              , self.labels_
+                                              , min_cluster_size=self.min_cluster_size
+                                              , dist_threshold=self.dist_threshold
+                                              , n_jobs=self.n_jobs
+                                              , neighbors_backend=self.neighbors_backend
+                                              )
+        self.absorber_.absorb(X, core_points_threshold=self.core_points_threshold,
+                              dvalue_threshold=self.dvalue_threshold)
+        self.labels_ = self.absorber_.membership(self.membership_format)
+        self.cores_ = self.absorber_.core_regions()
+        return self
+
+    def predict(self, X):
+        """Assigns new points to the clusters of the fitted model without clustering again: every point joins
+        the core and border regions of the clusters of its k nearest final core points (the cores left by the
+        peeling and the border points promoted to cores), with the core_points_threshold / dvalue_threshold rule
+        of the border region stage.
+        Parameters
+        ----------
+        X : array of features of the new points
+        Returns
+        -------
+        membership of the points of X in the clusters of labels_, in membership_format
+        """
+        if self.cores_ is None:
+            raise ValueError("This BorderPeel instance is not fitted yet, call fit() before predict()")
+        return bt.predict_membership(self.cores_, X, self.k, core_points_threshold=self.core_points_threshold,
+                                     dvalue_threshold=self.dvalue_threshold, membership_format=self.membership_format)
+
+    def fit_predict(self, X, X_plot_projection=None, nbrs_cache=None):
         """Performs BorderPeel clustering clustering on X and returns cluster labels.
         Parameters
         ----------
         X : array of features (TODO: make it work with sparse arrays)
         X_projected : A projection of the data to 2D used for plotting the graph during the cluster process
+        nbrs_cache : A NeighborCache of X, see fit()
         Returns
         -------
         y : ndarray, shape (n_samples,)
             cluster labels
         """
 
-        self.fit(X, X_plot_projection=X_plot_projection)
+        self.fit(X, X_plot_projection=X_plot_projection, nbrs_cache=nbrs_cache)
         return self.labels_
+
+    def save(self, path):
+        """Saves the fitted model to the directory path for predict(): the parameters, the memberships of the
+        fitted points and the final core regions (core points, their clusters and link thresholds and the
+        arrays of their neighbors index) as .npy files which load() memory-maps. The peeling itself is not
+        saved. NumPy scalar parameters are saved as numbers and an RPForestNeighbors neighbors_backend as its
+        parameters, other parameters which are not strings or numbers (e.g. another neighbors model) raise
+        a ValueError.
+        """
+        if self.cores_ is None:
+            raise ValueError("This BorderPeel instance is not fitted yet, call fit() before save()")
+        os.makedirs(path, exist_ok=True)
+        cores = self.cores_
+        params = {}
+        for key, value in self.get_params().items():
+            if isinstance(value, np.generic):
+                value = value.item()
+            if isinstance(value, RPForestNeighbors):
+                value = {"rp_forest": {name: int(getattr(value, name)) for name in ("n_trees", "leaf_size")}}
+            elif value is not None and not isinstance(value, (str, bool, int, float)):
+                raise ValueError("Can't save the %s parameter: %r" % (key, value))
+            params[key] = value
+        points_count = (len(self.labels_.labels) if isinstance(self.labels_, bt.CompactMembership)
+                        else self.labels_.shape[1])
+        with open(os.path.join(path, "model.json"), "w") as handle:
+            json.dump({"params": params, "clusters_count": int(cores.clusters_count), "points_count": points_count},
+                      handle, indent=1)
+
+        membership_clusters, membership_points = bt.membership_entries(self.labels_)
+        labels = (self.labels_.labels if isinstance(self.labels_, bt.CompactMembership)
+                  else bt.membership_to_labels(self.labels_))
+        arrays = {
+            "membership_clusters": membership_clusters
+            , "membership_points": membership_points
+            , "membership_labels": labels
+            , "core_indices": cores.core_indices
+            , "core_clusters": cores.core_clusters
+            , "link_thresholds": cores.link_thresholds
+        }
+        if cores.nbrs is not None:
+            # only the base model is saved, so the cores appended by partial_fit() are moved into it first
+            if cores.nbrs.delta_nbrs is not None:
+                cores.nbrs.fit_base()
+            arrays["core_points"] = cores.nbrs.data[:len(cores.nbrs)]
+            save_neighbors(cores.nbrs.base_nbrs, os.path.join(path, "index"))
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), np.asarray(array))
+        return self
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Loads a model saved by save() for predict(), with its arrays memory-mapped with mmap_mode (None reads
+        them to memory), so processes which load the same model share its pages. labels_ and cores_ are
+        restored, the other fitted attributes are left unset.
+        """
+        with open(os.path.join(path, "model.json")) as handle:
+            model = json.load(handle)
+        params = model["params"]
+        if isinstance(params.get("neighbors_backend"), dict):
+            params["neighbors_backend"] = RPForestNeighbors(**params["neighbors_backend"]["rp_forest"])
+        bp = cls(**params)
+
+        def load(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+        bp.labels_ = bt.to_membership_format(load("membership_clusters"), load("membership_points"),
+                                             load("membership_labels"), model["clusters_count"], bp.membership_format)
+        nbrs = None
+        if os.path.exists(os.path.join(path, "core_points.npy")):
+            core_points = load("core_points")
+            base_nbrs = load_neighbors(os.path.join(path, "index"), core_points, mmap_mode=mmap_mode,
+                                       n_jobs=bp.n_jobs, backend=bp.neighbors_backend)
+            nbrs = AppendableNeighbors(core_points, n_jobs=bp.n_jobs, backend=bp.neighbors_backend,
+                                       base_nbrs=base_nbrs)
+        bp.cores_ = bt.CoreRegions(load("core_indices"), load("core_clusters"), load("link_thresholds"),
+                                   model["clusters_count"], nbrs)
+        return bp
@@ -0,0 +1,77 @@
+import argparse
+import io
+import contextlib
+import numpy as np
+from time import time
+from M3W import border_tools as bt, BorderPeel, clustering_tools as ct
+from M3W.benchmark_suite import synthetic_embeddings
+from M3W.neighbors import NeighborCache, RPForestNeighbors
+
+from sklearn.metrics import adjusted_mutual_info_score
+from sklearn.metrics import adjusted_rand_score
+
+parser = argparse.ArgumentParser(
+    description='Compare the exact and the approximate (random projection forest) nearest neighbors backends')
+parser.add_argument('--input', type=str, metavar='<file path>', nargs='*', default=[],
+                    help='Labelled input files (as in run_m3w.py), the ground truth labels are in the last column')
+parser.add_argument('--synthetic', type=str, metavar='<points>x<dimension>', nargs='*',
+                    default=['20000x64', '20000x256'],
+                    help='Synthetic embeddings: blobs in a low dimensional space projected to the given dimension')
+parser.add_argument('--rp-trees', type=int, metavar='<trees>', default=16,
+                    help='Number of random projection trees (higher recall, slower)')
+parser.add_argument('--rp-leaf-size', type=int, metavar='<size>', default=64,
+                    help='Leaf size of the random projection trees (higher recall, slower)')
+parser.add_argument('--n-jobs', type=int, metavar='<jobs>', default=None,
+                    help='Number of parallel jobs (-1 for all the cores)', required=False)
+args = parser.parse_args()
+
+# Parameters of run_m3w.py
+k = 8
+C = 1.6
+T = 3
+alpha = 0.6
+beta = 0
+
+
+def run(data, neighbors_backend):
+    start = time()
+    nbrs_cache = NeighborCache(data, 2 * k, n_jobs=args.n_jobs, backend=neighbors_backend)
+    lambda_estimate = bt.estimate_lambda(data, k, nbrs_cache=nbrs_cache)
+    bp = BorderPeel.BorderPeel(
+        mean_border_eps=0.15
+        , max_iterations=T
+        , k=k
+        , min_cluster_size=2
+        , dist_threshold=lambda_estimate
+        , convergence_constant=0
+        , link_dist_expansion_factor=C
+        , verbose=False
+        , border_precentile=0.1
+        , stopping_precentile=0.01
+        , core_points_threshold=alpha
+        , dvalue_threshold=beta
+        , membership_format="csr"
+        , n_jobs=args.n_jobs
+        , neighbors_backend=neighbors_backend
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        membership = bp.fit_predict(data, nbrs_cache=nbrs_cache)
+    return time() - start, bt.membership_to_labels(membership), nbrs_cache.kneighbors(k)[1]
+
+
+datasets = [(path, ct.read_data(path)) for path in args.input]
+for spec in args.synthetic:
+    points_count, dimension = [int(v) for v in spec.split('x')]
+    datasets.append(("synthetic %s" % spec, synthetic_embeddings(points_count, dimension)))
+
+ann = RPForestNeighbors(n_trees=args.rp_trees, leaf_size=args.rp_leaf_size)
+print("%-30s %8s %5s %9s %9s %8s %7s %7s %7s %7s %7s" % (
+    "dataset", "points", "dim", "exact[s]", "rp[s]", "speedup", "recall", "ARI", "rp ARI", "AMI", "rp AMI"))
+for name, (data, labels) in datasets:
+    exact_time, exact_clusters, exact_indices = run(data, "exact")
+    ann_time, ann_clusters, ann_indices = run(data, ann)
+    recall = np.mean((ann_indices[:, :, np.newaxis] == exact_indices[:, np.newaxis, :]).any(axis=2))
+    print("%-30s %8d %5d %9.2f %9.2f %8.2f %7.3f %7.3f %7.3f %7.3f %7.3f" % (
+        name[-30:], len(data), data.shape[1], exact_time, ann_time, exact_time / ann_time, recall,
+        adjusted_rand_score(labels, exact_clusters), adjusted_rand_score(labels, ann_clusters),
+        adjusted_mutual_info_score(labels, exact_clusters), adjusted_mutual_info_score(labels, ann_clusters)))
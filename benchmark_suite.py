@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import numpy as np
+from multiprocessing import Pool
+from time import perf_counter
+from M3W import border_tools as bt, BorderPeel, clustering_tools as ct
+from M3W.neighbors import NeighborCache
+from M3W.profiling import peak_rss
+
+from sklearn.datasets import make_blobs
+from sklearn.metrics import adjusted_mutual_info_score
+from sklearn.metrics import adjusted_rand_score
+
+parser = argparse.ArgumentParser(description='Speed and quality benchmark of Multistep Three-way Clustering')
+parser.add_argument('--input', type=str, metavar='<file path>', nargs='*', default=[],
+                    help='Labelled input files (as in run_m3w.py), the ground truth labels are in the last column')
+parser.add_argument('--sizes', type=int, metavar='<points>', nargs='*', default=[10000, 30000, 100000],
+                    help='Numbers of points of the synthetic (and upscaled) datasets, e.g. 10000 100000 1000000')
+parser.add_argument('--dims', type=int, metavar='<dimension>', nargs='*', default=[2, 16, 128],
+                    help='Dimensions of the synthetic (and upscaled) datasets')
+parser.add_argument('--no-synthetic', action='store_true',
+                    help='Only run the input files and their upscaled versions, not the synthetic blobs')
+parser.add_argument('--n-jobs', type=int, metavar='<jobs>', default=None,
+                    help='Number of parallel jobs (-1 for all the cores)', required=False)
+parser.add_argument('--neighbors', type=str, choices=['exact', 'rp_forest'], default='exact',
+                    help='Nearest neighbors backend')
+parser.add_argument('--output', type=str, metavar='<file path>', default=None,
+                    help='Save the results to a json file')
+parser.add_argument('--compare', type=str, metavar='<file path>', default=None,
+                    help='Results json file of an earlier run (e.g. of another commit) to compare with')
+
+# Parameters of run_m3w.py
+k = 8
+C = 1.6
+T = 3
+alpha = 0.6
+beta = 0
+
+
+def synthetic_embeddings(points_count, dimension, intrinsic_dimension=10, centers=10, noise=0.3, random_state=0):
+    """Blobs in an intrinsic_dimension space projected to dimension (with noise), and their labels."""
+    intrinsic_dimension = min(intrinsic_dimension, dimension)
+    latent, labels = make_blobs(points_count, n_features=intrinsic_dimension, centers=centers,
+                                random_state=random_state)
+    rng = np.random.RandomState(random_state)
+    projection = rng.normal(size=(intrinsic_dimension, dimension)) / np.sqrt(intrinsic_dimension)
+    return latent.dot(projection) + rng.normal(scale=noise, size=(points_count, dimension)), labels
+
+
+def upscale(data, labels, points_count, dimension, noise=0.02, random_state=0):
+    """A larger version of a labelled dataset: points_count points drawn from data with gaussian jitter (noise
+    times the spread of every feature), rotated into a random subspace of dimension features when dimension is
+    larger than the one of the data (which keeps the distances between the points).
+    """
+    rng = np.random.RandomState(random_state)
+    data = np.asarray(data, dtype=np.float64)
+    rows = rng.randint(len(data), size=points_count)
+    upscaled = data[rows] + rng.normal(size=(points_count, data.shape[1])) * (noise * data.std(axis=0))
+    if dimension > data.shape[1]:
+        rotation = np.linalg.qr(rng.normal(size=(dimension, dimension)))[0][:data.shape[1]]
+        upscaled = upscaled.dot(rotation)
+    return upscaled, np.asarray(labels)[rows]
+
+
+def load_dataset(spec):
+    # datasets are built in the worker process, so they don't count in the peak memory of the other runs
+    kind, path, points_count, dimension = spec
+    if kind == "file":
+        return ct.read_data(path)
+    if kind == "upscaled":
+        return upscale(*ct.read_data(path), points_count=points_count, dimension=dimension)
+    return synthetic_embeddings(points_count, dimension)
+
+
+def run(task):
+    """Clusters a dataset in a worker process, returns its results dict."""
+    spec, n_jobs, neighbors_backend = task
+    data, labels = load_dataset(spec)
+    stages = {}
+    start = perf_counter()
+    nbrs_cache = NeighborCache(data, 2 * k, n_jobs=n_jobs, backend=neighbors_backend)
+    stages["neighbors"] = perf_counter() - start
+    lambda_estimate = bt.estimate_lambda(data, k, nbrs_cache=nbrs_cache)
+    stages["lambda"] = perf_counter() - start - stages["neighbors"]
+    bp = BorderPeel.BorderPeel(
+        mean_border_eps=0.15
+        , max_iterations=T
+        , k=k
+        , min_cluster_size=2
+        , dist_threshold=lambda_estimate
+        , convergence_constant=0
+        , link_dist_expansion_factor=C
+        , verbose=False
+        , border_precentile=0.1
+        , stopping_precentile=0.01
+        , core_points_threshold=alpha
+        , dvalue_threshold=beta
+        , membership_format="csr"
+        , n_jobs=n_jobs
+        , neighbors_backend=neighbors_backend
+        , profile=True
+    )
+    membership = bp.fit_predict(data, nbrs_cache=nbrs_cache)
+    seconds = perf_counter() - start
+    stages.update(bp.profile_.totals())
+    clusters = bt.membership_to_labels(membership)
+    return {
+        "dataset": dataset_name(spec)
+        , "points": len(data)
+        , "dim": data.shape[1]
+        , "seconds": seconds
+        , "peak_rss": peak_rss()
+        , "clusters": membership.shape[0]
+        , "ari": adjusted_rand_score(labels, clusters)
+        , "ami": adjusted_mutual_info_score(labels, clusters)
+        , "stages": stages
+    }
+
+
+def dataset_name(spec):
+    kind, path, points_count, dimension = spec
+    if kind == "file":
+        return os.path.basename(path)
+    if kind == "upscaled":
+        return "%s %dx%d" % (os.path.basename(path), points_count, dimension)
+    return "blobs %dx%d" % (points_count, dimension)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    specs = []
+    for path in args.input:
+        specs.append(("file", path, None, None))
+        specs.extend(("upscaled", path, points_count, dimension) for points_count in args.sizes
+                     for dimension in args.dims)
+    if not args.no_synthetic:
+        specs.extend(("blobs", None, points_count, dimension) for points_count in args.sizes for dimension in args.dims)
+
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as handle:
+            previous = {result["dataset"]: result for result in json.load(handle)["results"]}
+
+    print("%-40s %8s %5s %9s %9s %8s %7s %7s %9s %9s" % (
+        "dataset", "points", "dim", "seconds", "rss[MB]", "clusters", "ARI", "AMI", "time diff", "ARI diff"))
+    results = []
+    for spec in specs:
+        # a fresh process per run, so peak_rss is the peak of that run alone
+        with Pool(1) as pool:
+            result = pool.apply(run, ((spec, args.n_jobs, args.neighbors),))
+        results.append(result)
+        time_diff = ari_diff = ""
+        if result["dataset"] in previous:
+            time_diff = "%+8.1f%%" % (100 * (result["seconds"] / previous[result["dataset"]]["seconds"] - 1))
+            ari_diff = "%+9.3f" % (result["ari"] - previous[result["dataset"]]["ari"])
+        print("%-40s %8d %5d %9.2f %9.1f %8d %7.3f %7.3f %9s %9s" % (
+            result["dataset"][-40:], result["points"], result["dim"], result["seconds"],
+            (result["peak_rss"] or 0) / 2 ** 20, result["clusters"], result["ari"], result["ami"], time_diff,
+            ari_diff))
+
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump({
+                "commit": git_commit()
+                , "python": platform.python_version()
+                , "numpy": np.__version__
+                , "neighbors": args.neighbors
+                , "n_jobs": args.n_jobs
+                , "params": {"k": k, "C": C, "T": T, "alpha": alpha, "beta": beta}
+                , "results": results
+            }, handle, indent=1)
+        print("Saved the results to %s" % args.output)
@@ -1,35 +1,63 @@
 from sklearn.neighbors import NearestNeighbors
-from sklearn.neighbors import KNeighborsRegressor
+from sklearn.neighbors import KDTree
 from scipy.interpolate import griddata
-from python_algorithms.basic import union_find
-from time import time
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from M3W import union_find
+from M3W.numba_kernels import resolve_backend, exp_local_scaling_rknn_kernel
+from M3W.profiling import Profiler
+from M3W.neighbors import NeighborCache, GrowingNeighbors, IncrementalNeighbors, PeeledNeighbors, AppendableNeighbors, \
+    make_neighbors, map_blocks, drop_self, kneighbors_blocks, gather_rows
+from collections import namedtuple
+from joblib import effective_n_jobs
 import numpy as np
 import copy
 
 
-def rknn_with_distance_transform(data, k, transform):
-    rows_count = len(data)
-    k = min(k, rows_count - 1)
-    rknn_values = np.zeros(rows_count)
-    nbrs = NearestNeighbors(n_neighbors=k).fit(data)
-    distances, indices = nbrs.kneighbors()
+def rknn_with_distance_transform(data, k, transform, nbrs=None, n_jobs=None, backend="numpy", block_size=65536):
+    # nbrs can be a neighbors model which is already fitted on the data (e.g. IncrementalNeighbors),
+    # data is not used then
+    if nbrs is None:
+        k = min(k, len(data) - 1)
+        nbrs = NearestNeighbors(n_neighbors=k, n_jobs=n_jobs).fit(data)
+    distances, indices = nbrs.kneighbors(n_neighbors=k)
+    rows_count, k = distances.shape
+
+    # the numba backend has a compiled kernel for the exp local scaling transform only
+    if resolve_backend(backend) == "numba" and transform is exp_local_scaling_transform:
+        return exp_local_scaling_rknn_kernel(distances, indices, k, rows_count), nbrs
 
-    for index, indRow, distRow in zip(range(len(indices)), indices, distances):
-        for i, d in zip(indRow, distRow):
-            transform(rknn_values, index, i, d, indices, distances, k)
+    # every point adds the transformed distance to each of its k neighbors (reverse kNN), the contributions
+    # are computed for n_jobs blocks of rows at a time and added in the same row by row order as a sequential loop
+    rknn_values = np.zeros(rows_count)
+    chunk_size = block_size * effective_n_jobs(n_jobs)
+    for chunk_start in range(0, rows_count, chunk_size):
+        def contributions_block(start, stop):
+            start, stop = chunk_start + start, chunk_start + stop
+            return start, stop, transform(distances[start:stop], indices[start:stop], k)
+
+        chunk = map_blocks(contributions_block, min(chunk_size, rows_count - chunk_start), block_size, n_jobs)
+        for start, stop, contributions in chunk:
+            np.add.at(rknn_values, indices[start:stop].ravel(), contributions.ravel())
     return rknn_values, nbrs
 
 
-def exp_local_scaling_transform(rknnValues, first_index, second_index, dist, indices, distances, k):
+def exp_local_scaling_transform(distances, indices, k):
+    """Vectorized border value transform.
+
+    Gets the (rows, k) kNN distances and indices of the points and returns a (rows, k) array
+    with the contribution of every point to the rknn value of each of its neighbors. Transforms
+    must work row by row, since they may be called on blocks of the rows.
+    """
     first_scale_index = k
-    if len(distances[first_index]) <= first_scale_index:
-        first_scale_index = len(distances[first_index]) - 1
-    local_sigma = distances[first_index][first_scale_index]
-    rknnValues[second_index] = rknnValues[second_index] + np.exp(-(dist * dist) / (local_sigma * local_sigma))
+    if distances.shape[1] <= first_scale_index:
+        first_scale_index = distances.shape[1] - 1
+    local_sigma = distances[:, first_scale_index, np.newaxis]
+    return np.exp(-(distances * distances) / (local_sigma * local_sigma))
 
 
-def border_peel_single(data, border_func, threshold_func, precentile=0.1, verbose=False):
-    border_values, nbrs = border_func(data)
+def border_peel_single(data, border_func, threshold_func, precentile=0.1, verbose=False, nbrs=None):
+    border_values, nbrs = border_func(data, nbrs)
     if border_values is None:
         return None, None, None
     # calculate the precentile of the border value..
@@ -81,47 +109,72 @@ def evaluateLinkThresholds(data, filter, nbrs, dist_threshold):
 
 
 def update_link_thresholds(
-        current_data, original_indices, original_data, thresholds, dist_threshold, link_dist_expansion_factor, k=10
+        current_data, original_indices, original_data, thresholds, dist_threshold, link_dist_expansion_factor, k=10,
+        block_size=65536, n_jobs=None, peeled_nbrs=None, verbose=False
 ):
-    # index the filters according to the original data indices:
-    original_data_filter = np.zeros(len(original_data)).astype(int)
-    original_data_filter[original_indices] = 1
+    # the thresholds of the current points (original_indices, current_data isn't used) are interpolated from
+    # the thresholds of their k nearest peeled points.
+    # peeled_nbrs is a PeeledNeighbors which the caller updates with every peeled batch, without it the
+    # neighbors are searched among all the peeled points
+    if peeled_nbrs is None:
+        original_data_filter = np.zeros(len(original_data)).astype(int)
+        original_data_filter[original_indices] = 1
+        peeled_nbrs = PeeledNeighbors(original_data, k, block_size=block_size, n_jobs=n_jobs)
+        peeled_nbrs.add(np.flatnonzero(original_data_filter == 0), original_indices)
+
+    if not peeled_nbrs.ready:
+        if verbose:
+            print("fewer than k peeled points, thresholds unchanged")
+        return thresholds
 
-    xy = original_data[(original_data_filter == 0)]  # cords of borders
-    Z = thresholds[(original_data_filter == 0)]  # link thresholds of borders
+    new_thresholds = np.concatenate([np.zeros(0)] + map_blocks(
+        lambda start, stop: thresholds[peeled_nbrs.indices[original_indices[start:stop]]].mean(axis=1),
+        len(original_indices), block_size, n_jobs
+    ))
 
-    knn = KNeighborsRegressor(k, weights="uniform")
+    # fmin also replaces nan thresholds with dist_threshold
+    thresholds[original_indices] = np.fmin(new_thresholds * link_dist_expansion_factor, dist_threshold)
+    return thresholds
 
-    try:
-        new_thresholds = knn.fit(xy, Z).predict(current_data)
-    except:
-        print("failed to run kneighbours regressor")
-        return thresholds
 
-    for i, p, t in zip(range(len(current_data)), current_data, new_thresholds):
-        original_index = original_indices[i]
-        if np.isnan(t):
-            print("threshold is nan")
+class PeelHistory:
+    """The data sets of the peeling iterations, reconstructed on demand from the iteration each point was
+    peeled at.
 
-        if np.isnan(t) or (t * link_dist_expansion_factor) > dist_threshold:
-            # print "setting dist threshold"
-            thresholds[original_index] = dist_threshold
-        else:
-            # print "setting threhold: %.2f"%(t * link_dist_expansion_factor)
-            thresholds[original_index] = t * link_dist_expansion_factor
+    history[0] is the data itself and history[t] is the data which remained after iteration t - 1, in the
+    original order of the points.
+    """
 
-    return thresholds
+    def __init__(self, data, max_iterations):
+        self.data = data
+        self.iterations_count = 0
+        # -1 for the points which weren't peeled
+        self.peeled_at = np.ones(len(data), dtype=np.int16 if max_iterations < 2 ** 15 else np.int32) * -1
+
+    def add_iteration(self, peeled_indices):
+        self.peeled_at[peeled_indices] = self.iterations_count
+        self.iterations_count += 1
 
+    def indices(self, t):
+        if t < 0:
+            t += len(self)
+        if t < 0 or t >= len(self):
+            raise IndexError("peel history index out of range")
+        return np.flatnonzero((self.peeled_at == -1) | (self.peeled_at >= t))
 
-class StopWatch:
-    def __init__(self):
-        self.time = time()
+    def __len__(self):
+        return self.iterations_count + 1
 
-    def t(self, message):
-        print("watch: %s: %0.4f" % (message, time() - self.time))
+    def __getitem__(self, t):
+        if isinstance(t, slice):
+            return [self[i] for i in range(*t.indices(len(self)))]
+        if t == 0 or t == -len(self):
+            return self.data
+        return self.data[self.indices(t)]
 
-        # pass
-        # self.time = time()
+    def __iter__(self):
+        for t in range(len(self)):
+            yield self[t]
 
 
 def dynamic_3w(
@@ -145,12 +198,126 @@ def dynamic_3w(
         , debug_marker_size=70
         , core_points_threshold=1
         , dvalue_threshold=1
+        , core_merge_method="radius"
+        , membership_format="dense"
+        , out_of_core_dir=None
+        , block_size=65536
+        , n_jobs=None
+        , backend="numpy"
+        , nbrs_cache=None
+        , neighbors_backend="exact"
+        , profiler=None
 ):
-    watch = StopWatch()
+    """
+    With out_of_core_dir the neighbor tables are kept in disk backed arrays under that directory (data can
+    be memory-mapped as well) and are computed in blocks of block_size rows, as are the core points and the rknn
+    values. The memory then holds O(n) per point arrays, O(block_size * k) blocks, and the neighbors of the
+    points peeled in an iteration while their referencing rows are repaired. The
+    associations map is None then and the non merged core points are the core points themselves. Peeling always
+    works on the indices of the remaining points, and the data sets of the iterations are returned as a
+    PeelHistory.
+    n_jobs (joblib semantics, -1 for all the cores) is used by the neighbor models and the blocked stages.
+    backend is "numpy" or "numba" (compiled association and union loops, when numba is installed).
+    nbrs_cache is a NeighborCache of data with at least min(2 * k, n - 1) neighbors (e.g. the one used
+    by estimate_lambda), one is computed when it isn't given.
+    neighbors_backend is the kNN backend of the neighbor models: "exact", "rp_forest" (approximate, for high
+    dimensional data) or a model with the fit(X) and kneighbors(X, n_neighbors) methods, e.g. a tuned
+    neighbors.RPForestNeighbors. With an approximate backend the radius core merge links every core point
+    to its 2 * k nearest core points at most.
+    The peeling and core merge (peel_and_merge) and the three-way assignment (three_way_assignment) are
+    separate stages, the assignment can be rerun with other alpha/beta settings on the same peeling.
+    profiler is a profiling.Profiler which records the stages of the run.
+    """
+    peeling = peel_and_merge(
+        data
+        , border_func
+        , threshold_func
+        , max_iterations=max_iterations
+        , min_iterations=min_iterations
+        , mean_border_eps=mean_border_eps
+        , plot_debug_output_dir=plot_debug_output_dir
+        , dist_threshold=dist_threshold
+        , convergence_constant=convergence_constant
+        , link_dist_expansion_factor=link_dist_expansion_factor
+        , k=k
+        , verbose=verbose
+        , precentile=precentile
+        , vis_data=vis_data
+        , stopping_precentile=stopping_precentile
+        , should_merge_core_points=should_merge_core_points
+        , debug_marker_size=debug_marker_size
+        , core_merge_method=core_merge_method
+        , out_of_core_dir=out_of_core_dir
+        , block_size=block_size
+        , n_jobs=n_jobs
+        , backend=backend
+        , nbrs_cache=nbrs_cache
+        , neighbors_backend=neighbors_backend
+        , profiler=profiler
+    )
+    membership = three_way_assignment(
+        peeling
+        , min_cluster_size=min_cluster_size
+        , core_points_threshold=core_points_threshold
+        , dvalue_threshold=dvalue_threshold
+        , membership_format=membership_format
+        , n_jobs=n_jobs
+        , neighbors_backend=neighbors_backend
+        , profiler=profiler
+        , out_of_core_dir=out_of_core_dir
+    )
+
+    return membership, peeling.core_points, peeling.non_merged_core_points, peeling.data_sets, peeling.uf_map, \
+           peeling.link_thresholds, peeling.border_values_per_iteration, peeling.original_indices
+
+
+# the result of the peeling and core merge stage of dynamic_3w: the roots of the merged sets of all the points,
+# the core points (the points which remained after peeling) and the peeled layers
+PeelingResult = namedtuple("PeelingResult", [
+    "data", "k", "cluster_roots", "core_points_indices", "border_indices_per_iteration", "core_points",
+    "non_merged_core_points", "data_sets", "uf_map", "link_thresholds", "border_values_per_iteration",
+    "original_indices"
+])
+
+
+def peel_and_merge(
+        data
+        , border_func
+        , threshold_func
+        , max_iterations=150
+        , min_iterations=3
+        , mean_border_eps=-1
+        , plot_debug_output_dir=None
+        , dist_threshold=3
+        , convergence_constant=0
+        , link_dist_expansion_factor=3
+        , k=10
+        , verbose=True
+        , precentile=0.1
+        , vis_data=None
+        , stopping_precentile=0
+        , should_merge_core_points=True
+        , debug_marker_size=70
+        , core_merge_method="radius"
+        , out_of_core_dir=None
+        , block_size=65536
+        , n_jobs=None
+        , backend="numpy"
+        , nbrs_cache=None
+        , neighbors_backend="exact"
+        , profiler=None
+):
+    """The peeling and core merge stage of dynamic_3w (see its parameters), returns a PeelingResult which
+    three_way_assignment() turns into memberships. The result doesn't depend on the assignment parameters
+    (alpha, beta and the minimal cluster size), so it can be assigned with several of them.
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    backend = resolve_backend(backend)
 
     # original_data_points_indices = {}
     data_length = len(data)
-    cluster_uf = union_find.UF(data_length)
+    cluster_uf = union_find.UF(data_length, backend=backend)
     original_indices = np.arange(data_length)
     link_thresholds = np.ones(data_length) * dist_threshold
     # for d,i in zip(data,xrange(data_length)):
@@ -159,10 +326,8 @@ def dynamic_3w(
     if vis_data is None:
         vis_data = data
     original_vis_data = vis_data
-    current_vis_data = vis_data
 
     original_data = data
-    current_data = data
     data = None
 
     # 1 if the point wasn't peeled yet, 0 if it was
@@ -172,9 +337,19 @@ def dynamic_3w(
     # plt_dbg_session = DebugPlotSession(plot_debug_output_dir, marker_size=debug_marker_size, line_width=1.0)
     initial_core_points = []
     initial_core_points_original_indices = []
-    data_sets = [original_data]
-    nbrs = NearestNeighbors(n_neighbors=len(current_data) - 1).fit(current_data)
-    nbrs_distances, nbrs_indices = nbrs.kneighbors()
+    data_sets = PeelHistory(original_data, max_iterations)
+    # a single kNN computation of the data feeds both the association table and the rknn neighbors
+    if nbrs_cache is None:
+        nbrs_cache = NeighborCache(original_data, 2 * k, directory=out_of_core_dir, block_size=block_size,
+                                   n_jobs=n_jobs, backend=neighbors_backend)
+    # links never reach beyond dist_threshold, so a short neighbor list per point is grown only where needed
+    link_nbrs = GrowingNeighbors(original_data, 2 * k, cache=nbrs_cache)
+    # the k nearest neighbors of the remaining points, repaired as points are peeled
+    rknn_nbrs = IncrementalNeighbors(original_data, k, directory=out_of_core_dir, block_size=block_size,
+                                     cache=nbrs_cache)
+    # the k nearest peeled points of the remaining points, for the interpolation of their link thresholds
+    peeled_nbrs = PeeledNeighbors(original_data, k, directory=out_of_core_dir, block_size=block_size, n_jobs=n_jobs,
+                                  backend=neighbors_backend)
     max_core_points = stopping_precentile * data_length
     border_values_per_iteration = []
     border_indices_per_iteration = []
@@ -182,18 +357,19 @@ def dynamic_3w(
     if mean_border_eps > 0:
         mean_border_vals = []
 
-    watch.t("initialization")
+    profiler.stage("initialization")
 
     for t in range(max_iterations):
-        start_time = time()
+        profiler.iteration = t
         filter, border_values, nbrs = border_peel_single(
-            current_data
+            None
             , border_func
             , threshold_func
             , precentile=precentile
             , verbose=verbose
+            , nbrs=rknn_nbrs
         )
-        watch.t("rknn")
+        profiler.stage("rknn")
         peeled_border_values = border_values[filter == False]
         border_values_per_iteration.append(peeled_border_values)
 
@@ -215,10 +391,8 @@ def dynamic_3w(
                 print("nbrs are none, breaking")
             break
 
-        watch.t("mean borders")
+        profiler.stage("mean borders")
         # filter out data points
-        links = []
-
         # mark and distinguish all core (=1) and border (=0) points
         original_data_filter = np.zeros(data_length).astype(int)
         original_indices_new = original_indices[filter]
@@ -226,43 +400,25 @@ def dynamic_3w(
         border_indices_per_iteration.append(border_indices_new)
         original_data_filter[original_indices_new] = 1
 
-        watch.t("nearset neighbors")
-
-        # update link thresholds of borders
-        for d, i, nn_inds, nn_dists in zip(current_data, range(len(current_data)), nbrs_indices, nbrs_distances):
-            # skip non border points
-            if filter[i]:
-                continue
-            # find the next neighbor we can link to
-            original_index = original_indices[i]
-            link_nig_index = -1
-            link_nig_dist = -1
-            # make sure we exclude self point here..
-            link_threshold = link_thresholds[original_index]
-            for nig_index, nig_dist in zip(nn_inds, nn_dists):
-                if nig_dist > link_threshold:
-                    break
-
-                if not original_data_filter[nig_index]:  # choose non border and skip border
-                    continue
-
-                link_nig_index = nig_index
-                link_nig_dist = nig_dist
-                break  # nearst non border of the border
-
-            # do not link this point to any other point (but still remove it), consider it as noise instead for now
-            # this will generally mean that this point is sorrounded by other border points
-            if link_nig_index > -1:
-                links.append((i, link_nig_index))
-                original_link_nig_index = link_nig_index
-                # cluster_uf.union(original_index, original_link_nig_index)  # border link to core
-                link_thresholds[original_index] = link_nig_dist
-            # else:  # leave it in a seperate cluster...
-            #     initial_core_points.append(d) # add outliers
-            #     initial_core_points_original_indices.append(original_index)
-            #     filter[i] = False
-
-        watch.t("association")
+        profiler.stage("nearest neighbors")
+
+        # update link thresholds of borders:
+        # link every border to its nearst non border neighbor within its link threshold (the self point
+        # is excluded from the neighbors)
+        border_positions = np.flatnonzero(~filter)
+        link_nig_indices, link_nig_dists = link_nbrs.first_neighbors(
+            border_indices_new, link_thresholds[border_indices_new], original_data_filter, backend=backend
+        )
+
+        # do not link the border points without such a neighbor to any other point (but still remove them),
+        # consider them as noise instead for now
+        # this will generally mean that these points are sorrounded by other border points
+        linked = link_nig_indices > -1
+        links = np.column_stack((border_positions[linked], link_nig_indices[linked]))
+        # cluster_uf.union(border_indices_new[linked], link_nig_indices[linked])  # border link to core
+        link_thresholds[border_indices_new[linked]] = link_nig_dists[linked]
+
+        profiler.stage("association", links=int(np.count_nonzero(linked)))
 
         # if (plot_debug_output_dir != None):
         #     original_data_filter = 2 * np.ones(len(original_data)).astype(int)
@@ -275,126 +431,190 @@ def dynamic_3w(
 
         # update params for next iterations
         # interpolate the threshold values for the next iteration:
-        previous_iteration_data_length = len(current_data)
+        previous_iteration_data_length = len(original_indices)
         # filter the data:
-        current_data = current_data[filter]
-        current_vis_data = current_vis_data[filter]
-        data_sets.append(current_data)
         original_indices = original_indices_new
-        nbrs_indices = nbrs_indices[filter]
-        nbrs_distances = nbrs_distances[filter]
+        data_sets.add_iteration(border_indices_new)
+        rknn_nbrs.remove(border_indices_new)
+        peeled_nbrs.add(border_indices_new, original_indices)
 
-        watch.t("filter")
+        profiler.stage("filter", peeled=len(border_indices_new), remaining=len(original_indices))
 
         # calculate and update the link thresholds for non borders:
         link_thresholds = update_link_thresholds(
-            current_data
+            None
             , original_indices
             , original_data
             , link_thresholds
             , dist_threshold
             , link_dist_expansion_factor
             , k=k
+            , block_size=block_size
+            , n_jobs=n_jobs
+            , peeled_nbrs=peeled_nbrs
+            , verbose=verbose
         )
 
-        watch.t("thresholds")
+        profiler.stage("thresholds")
 
         if verbose:
             print("iteration %d, peeled: %d, remaining data points: %d, number of sets: %d" \
-                  % (t, abs(len(current_data) - previous_iteration_data_length), len(current_data), cluster_uf.count()))
-        if abs(len(current_data) - previous_iteration_data_length) < convergence_constant:
+                  % (t, abs(len(original_indices) - previous_iteration_data_length), len(original_indices), cluster_uf.count()))
+        if abs(len(original_indices) - previous_iteration_data_length) < convergence_constant:
             if verbose:
                 print("stopping peeling since difference between remaining data points and current is: %d" % (
-                    abs(len(current_data) - previous_iteration_data_length)))
+                    abs(len(original_indices) - previous_iteration_data_length)))
             break
 
-        if max_core_points > len(current_data):
+        if max_core_points > len(original_indices):
             if verbose:
                 print("number of core points is below the max threshold, stopping")
             break
 
-    watch.t("before merge")
-    clusters = np.ones(len(original_data)) * -1
+    profiler.iteration = None
 
     if verbose:
         print("before merge: %d" % cluster_uf.count())
-    print(initial_core_points_original_indices)
+        print(initial_core_points_original_indices)
 
     # core region clustering
-    core_points_merged = current_data.tolist() + initial_core_points
-
-    original_core_points_indices = original_indices.tolist() + initial_core_points_original_indices
-
-    core_points = np.ndarray(shape=(len(core_points_merged), len(core_points_merged[0])),
-                             buffer=np.array(core_points_merged))
+    original_core_points_indices = np.concatenate((original_indices, np.asarray(
+        initial_core_points_original_indices, dtype=original_indices.dtype)))
+
+    # out of core, the core points are gathered to a disk backed array, and the copy of the core points
+    # before the merge (which doesn't change them) and the associations map (a dict of lists of all the
+    # points) are skipped
+    if out_of_core_dir is None:
+        core_points = np.array(original_data[original_core_points_indices], dtype=np.float64)
+    else:
+        core_points = gather_rows(original_data, original_core_points_indices, np.float64, out_of_core_dir,
+                                  block_size)
 
-    watch.t("before to associations map")
+    profiler.stage("core points", cores=len(original_core_points_indices))
 
-    uf_map = uf_to_associations_map(cluster_uf, core_points, original_core_points_indices)
+    uf_map = None
+    if out_of_core_dir is None:
+        uf_map = uf_to_associations_map(cluster_uf, core_points, original_core_points_indices)
 
-    watch.t("after associations map")
+    profiler.stage("associations map")
 
-    non_merged_core_points = copy.deepcopy(core_points)
+    non_merged_core_points = copy.deepcopy(core_points) if out_of_core_dir is None else core_points
 
     if should_merge_core_points:
-        merge_core_points(core_points, link_thresholds, original_core_points_indices, cluster_uf, verbose)
+        merge_core_points(core_points, link_thresholds, original_core_points_indices, cluster_uf, verbose,
+                          method=core_merge_method, n_jobs=n_jobs, neighbors_backend=neighbors_backend,
+                          max_links=2 * k, profiler=profiler)
 
-    watch.t("core points merge")
+    profiler.stage("core sets", sets=cluster_uf.count())
 
     if verbose:
         print("after merge: %d" % cluster_uf.count())
 
-    cluster_lists = union_find_to_lists(cluster_uf)
-
-    cluster_index = 0
-
-    for l in cluster_lists:
-        if len(l) < min_cluster_size:
-            continue
-
-        for i in l:
-            clusters[i] = cluster_index
-
-        cluster_index += 1
-
-    # construct membership array
-    membership = np.zeros((cluster_index, len(original_data)))
-    for col in range(len(clusters)):
-        row = int(clusters[col])
-        if row != -1:
-            membership[row][col] = 1
-
-    # membership array of cores
-    clusters_core = clusters[original_core_points_indices]
-    membership_core = membership[:, original_core_points_indices]
+    return PeelingResult(
+        data=original_data
+        , k=k
+        , cluster_roots=cluster_uf.find_all()
+        , core_points_indices=original_core_points_indices
+        , border_indices_per_iteration=border_indices_per_iteration
+        , core_points=core_points
+        , non_merged_core_points=non_merged_core_points
+        , data_sets=data_sets
+        , uf_map=uf_map
+        , link_thresholds=link_thresholds
+        , border_values_per_iteration=border_values_per_iteration
+        , original_indices=original_indices
+    )
+
+
+def three_way_assignment(
+        peeling
+        , min_cluster_size=3
+        , core_points_threshold=1
+        , dvalue_threshold=1
+        , membership_format="dense"
+        , n_jobs=None
+        , neighbors_backend="exact"
+        , profiler=None
+        , return_cores=False
+        , out_of_core_dir=None
+):
+    """The three-way assignment stage of dynamic_3w (see its parameters): numbers the merged sets of the
+    PeelingResult with at least min_cluster_size points as clusters and assigns the peeled points to core
+    and border regions layer by layer, from the last peeled layer to the first. Returns the membership,
+    and the final CoreRegions as well when return_cores is set. With out_of_core_dir the index of the core
+    points keeps them in disk backed arrays under that directory.
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    original_data = peeling.data
+    data_length = len(original_data)
+    k = peeling.k
+    original_core_points_indices = peeling.core_points_indices
+    border_indices_per_iteration = peeling.border_indices_per_iteration
+
+    # number the sets which are large enough by their smallest item (which is their root)
+    cluster_roots = peeling.cluster_roots
+    large_roots = np.flatnonzero(np.bincount(cluster_roots, minlength=data_length) >= max(min_cluster_size, 1))
+    cluster_index = len(large_roots)
+    root_clusters = np.ones(data_length) * -1
+    root_clusters[large_roots] = np.arange(cluster_index)
+    clusters = root_clusters[cluster_roots]
+
+    # construct membership array entries (cluster, point)
+    clustered = np.flatnonzero(clusters != -1)
+    membership_rows = [clusters[clustered].astype(int)]
+    membership_cols = [clustered]
+    primary_labels = clusters.astype(int)
+
+    # clusters of the core points, kept in buffers sized for all the points which only grow as border
+    # points are assigned to core regions
+    cores_count = len(original_core_points_indices)
+    core_points_buffer = np.zeros(data_length, dtype=int)
+    core_points_buffer[:cores_count] = original_core_points_indices
+    clusters_core = np.ones(data_length, dtype=int) * -1
+    clusters_core[:cores_count] = clusters[original_core_points_indices]
+    profiler.stage("clusters", clusters=cluster_index)
+    # border region clustering (there is nothing to assign the border points to without clusters)
+    border_layers = range(len(border_indices_per_iteration) - 1, -1, -1) if cluster_index > 0 else []
+    nbrs_core = None
+    if cluster_index > 0:
+        # spatial index of the core points which new core points are appended to
+        if out_of_core_dir is None:
+            core_data = original_data[original_core_points_indices, :]
+        else:
+            core_data = gather_rows(original_data, original_core_points_indices, original_data.dtype,
+                                    out_of_core_dir)
+        nbrs_core = AppendableNeighbors(core_data, n_jobs=n_jobs, backend=neighbors_backend,
+                                        directory=out_of_core_dir)
 
-    # border region clustering
-    for i in range(len(border_indices_per_iteration) - 1, -1, -1):
+    for i in border_layers:
         border_indices = border_indices_per_iteration[i]  # Index of boundary points in the innermost layer
         border_data = original_data[border_indices, :]
-        core_data = original_data[original_core_points_indices, :]
         # find the set of core k nearest neighbors of x_i
-        nbrs_core = NearestNeighbors(n_neighbors=k).fit(core_data)
-        nbrs_core_distances, nbrs_core_indices = nbrs_core.kneighbors(border_data)
-        for j in range(len(border_indices)):
-            # assign peeled points to the cluster whose k-core neighbors have the most membership
-            nei_members = membership_core[:, nbrs_core_indices[j, :]]
-            nei_mean_members = np.mean(nei_members, axis=1)
-            nei_most_cluster = np.argmax(nei_mean_members)
-            nei_most_pos = nei_mean_members[nei_most_cluster]
-            membership[nei_most_cluster, border_indices[j]] = 1
-            if nei_most_pos >= core_points_threshold or (np.count_nonzero(
-                    ((nei_most_pos - nei_mean_members) <= (dvalue_threshold / cluster_index))) <= 1):
-                # assign the peeled point to a core region
-                clusters_core = np.append(clusters_core, nei_most_cluster)
-                add_membership_core = np.zeros((cluster_index, 1))
-                add_membership_core[nei_most_cluster] = 1
-                membership_core = np.concatenate((membership_core, add_membership_core), axis=1)
-                original_core_points_indices.append(border_indices[j])
-            else:  # assign the peeled point to border regions
-                regions_filter = (nei_most_pos - nei_mean_members) <= (dvalue_threshold / cluster_index)
-                nei_clusters = np.where(regions_filter == True)
-                membership[nei_clusters, border_indices[j]] = 1
+        nbrs_core_distances, nbrs_core_indices = nbrs_core.kneighbors(border_data, k)
+
+        # the core points of a layer only come from the previous layers, so the whole layer is assigned at once.
+        nei_most_cluster, to_core, border_rows, nei_clusters = assign_regions(
+            clusters_core[nbrs_core_indices], cluster_index, core_points_threshold, dvalue_threshold
+        )
+        membership_rows.append(nei_most_cluster)
+        membership_cols.append(border_indices)
+        primary_labels[border_indices] = np.where(primary_labels[border_indices] == -1, nei_most_cluster,
+                                                  primary_labels[border_indices])
+
+        # assign the peeled points to a core region
+        new_cores_count = cores_count + np.count_nonzero(to_core)
+        core_points_buffer[cores_count:new_cores_count] = border_indices[to_core]
+        clusters_core[cores_count:new_cores_count] = nei_most_cluster[to_core]
+        cores_count = new_cores_count
+        nbrs_core.append(original_data[border_indices[to_core], :])
+
+        # assign the rest of the peeled points to border regions
+        membership_rows.append(nei_clusters)
+        membership_cols.append(border_indices[border_rows])
+        profiler.iteration = i
+        profiler.stage("border layer", points=len(border_indices), cores=int(np.count_nonzero(to_core)))
+    profiler.iteration = None
 
     # if plot_debug_output_dir != None:
     #     for original_index in original_indices:
@@ -406,92 +626,513 @@ def dynamic_3w(
     #     # draw all of the clusters
     #     plt_dbg_session.plot_clusters_and_save(original_vis_data, clusters)
 
-    watch.t("before return")
-
-    return membership, core_points, non_merged_core_points, data_sets, uf_map, link_thresholds, \
-           border_values_per_iteration, original_indices
-
-
-def estimate_lambda(data, k):
+    membership = to_membership_format(
+        np.concatenate(membership_rows), np.concatenate(membership_cols), primary_labels, cluster_index,
+        membership_format
+    )
+
+    profiler.stage("membership")
+
+    if return_cores:
+        if nbrs_core is not None and nbrs_core.delta_nbrs is not None:
+            # a single model over all the cores answers the later queries faster
+            nbrs_core.fit_base()
+        core_indices = core_points_buffer[:cores_count]
+        cores = CoreRegions(core_indices, clusters_core[:cores_count], peeling.link_thresholds[core_indices],
+                            cluster_index, nbrs_core)
+        return membership, cores
+    return membership
+
+
+def assign_regions(nbrs_clusters, clusters_count, core_points_threshold, dvalue_threshold):
+    """The three-way rule of the border region stage, given the (points, k) clusters of the k nearest core points
+    of every point: the cluster whose core neighbors have the most membership, whether the point joins the
+    core region of that cluster (the membership is at least core_points_threshold, or no other cluster is within
+    dvalue_threshold of it) and the (point, cluster) entries of the border regions of the points which don't,
+    ordered by point and then by cluster.
+
+    Only the at most k clusters of the neighbors of a point are scored. The clusters without core neighbors
+    have no membership, so they are in the border regions of a point only when its most cluster is within
+    dvalue_threshold of 0 (then the point has entries in all of them).
+    """
+    rows_count, k = nbrs_clusters.shape
+    rows, clusters, counts = neighbor_cluster_counts(nbrs_clusters)
+    mean_members = counts / k
+
+    # the cluster with the most members, the smallest one on ties (and 0 without clustered neighbors, as argmax)
+    order = np.lexsort((clusters, -counts, rows))
+    most = order[np.unique(rows[order], return_index=True)[1]]
+    most_cluster = np.zeros(rows_count, dtype=int)
+    most_cluster[rows[most]] = clusters[most]
+    most_pos = np.zeros(rows_count)
+    most_pos[rows[most]] = mean_members[most]
+
+    dvalue = dvalue_threshold / clusters_count
+    in_band = (most_pos[rows] - mean_members) <= dvalue
+    empty_in_band = (most_pos - 0.0) <= dvalue
+    band_count = np.bincount(rows[in_band], minlength=rows_count) + np.where(
+        empty_in_band, clusters_count - np.bincount(rows, minlength=rows_count), 0
+    )
+    to_core = (most_pos >= core_points_threshold) | (band_count <= 1)
+
+    # border regions of the clusters with members, and of all the clusters without members where they are in
+    # the band (the membership itself has an entry per cluster for these points)
+    border = in_band & ~to_core[rows]
+    border_rows = [rows[border]]
+    border_clusters = [clusters[border]]
+    expanded = np.flatnonzero(empty_in_band & ~to_core)
+    if len(expanded) > 0:
+        positions = np.ones(rows_count, dtype=int) * -1
+        positions[expanded] = np.arange(len(expanded))
+        empty = np.ones((len(expanded), clusters_count), dtype=bool)
+        has_position = positions[rows] > -1
+        empty[positions[rows[has_position]], clusters[has_position]] = False
+        empty_rows, empty_clusters = np.nonzero(empty)
+        border_rows.append(expanded[empty_rows])
+        border_clusters.append(empty_clusters)
+    border_rows = np.concatenate(border_rows)
+    border_clusters = np.concatenate(border_clusters)
+    order = np.lexsort((border_clusters, border_rows))
+    return most_cluster, to_core, border_rows[order], border_clusters[order]
+
+
+# the core regions after the three-way assignment stage: the original indices of the core points (the
+# peeling cores and the promoted border points), their clusters (-1 for the sets too small to be clusters) and
+# link thresholds, the number of clusters and an AppendableNeighbors index of the core points in the same order
+# (None without clusters)
+CoreRegions = namedtuple("CoreRegions", ["core_indices", "core_clusters", "link_thresholds", "clusters_count",
+                                         "nbrs"])
+
+
+def predict_membership(cores, X, k, core_points_threshold=1, dvalue_threshold=1, membership_format="dense"):
+    """Membership of new points X in the clusters of the CoreRegions of a fitted model: every point is assigned
+    to the core and border regions with the rule of the border region stage (assign_regions) from its k nearest
+    core points. The cores are not updated, so the points of X are assigned independently of each other.
+    """
+    X = np.asarray(X)
+    points_count = len(X)
+    if cores.clusters_count == 0 or points_count == 0:
+        return to_membership_format(np.zeros(0, dtype=int), np.zeros(0, dtype=int),
+                                    np.ones(points_count, dtype=int) * -1, cores.clusters_count, membership_format)
+
+    nbrs_core_indices = cores.nbrs.kneighbors(X, min(k, len(cores.nbrs)))[1]
+    most_cluster, to_core, border_rows, border_clusters = assign_regions(
+        cores.core_clusters[nbrs_core_indices], cores.clusters_count, core_points_threshold, dvalue_threshold
+    )
+    return to_membership_format(np.concatenate((most_cluster, border_clusters)),
+                                np.concatenate((np.arange(points_count), border_rows)), most_cluster,
+                                cores.clusters_count, membership_format)
+
+
+def append_rows(array, size, rows):
+    """Writes rows after the first size rows of array, which is replaced by one of twice its capacity when it is
+    full. Returns the array.
+    """
+    new_size = size + len(rows)
+    if new_size > len(array):
+        grown = np.zeros((max(new_size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+        grown[:size] = array[:size]
+        array = grown
+    array[size:new_size] = rows
+    return array
+
+
+class BatchAbsorber:
+    """Absorbs batches of new points into a fitted model (the PeelingResult, CoreRegions and membership of the
+    three-way assignment stage) without peeling all the points again.
+
+    The kNN table and the rknn border values of all the points are kept up to date: a batch only requeries the
+    neighbors of the points which get a new point among their k nearest neighbors (searched among the 2 * k
+    nearest neighbors of the new points, which misses some of them in high dimensions) and updates the border
+    values of their neighbors. A new point whose border value is above the border value of the fraction of the fitted
+    points which were peeled becomes a core point. Its link threshold is the mean of the thresholds of its k
+    nearest core points, it is linked to the core points within the link threshold of either one (as in
+    merge_core_points) and the clusters are merged along its links, new sets of at least min_cluster_size core
+    points become new clusters. The other new points are assigned as a border layer with the rule of the border
+    region stage. Only the new points are classified: the older points whose border values change keep their
+    core or border status and their membership entries (which only follow the merges of their clusters), even
+    when their border values cross the core threshold, so the result approximates a refit.
+    """
+
+    def __init__(self, peeling, cores, membership, min_cluster_size=3, dist_threshold=3, n_jobs=None,
+                 neighbors_backend="exact"):
+        data = peeling.data
+        self.min_cluster_size = min_cluster_size
+        self.dist_threshold = dist_threshold
+        self.n_jobs = n_jobs
+        self.neighbors_backend = neighbors_backend
+        self.k = min(peeling.k, len(data) - 1)
+
+        # all the points, their k nearest neighbors and border values
+        self.points = AppendableNeighbors(data, n_jobs=n_jobs, backend=neighbors_backend)
+        self.size = len(data)
+        self.distances, self.indices = kneighbors_blocks(self.points.base_nbrs, self.points.data[:self.size], self.k,
+                                                         n_jobs=n_jobs)
+        self.distances = np.array(self.distances)
+        self.indices = np.array(self.indices)
+        self.border_values = np.bincount(self.indices.ravel(), minlength=self.size, weights=exp_local_scaling_transform(
+            self.distances, self.indices, self.k).ravel())
+        peeled_count = self.size - len(peeling.core_points_indices)
+        self.core_threshold = np.sort(self.border_values)[min(peeled_count, self.size - 1)]
+
+        # the core regions, and the roots of the merged sets of the fitted points
+        self.cluster_roots = np.array(peeling.cluster_roots)
+        self.cores_count = len(cores.core_indices)
+        self.core_indices = np.array(cores.core_indices)
+        self.core_clusters = np.array(cores.core_clusters)
+        self.link_thresholds = np.array(cores.link_thresholds)
+        self.clusters_count = cores.clusters_count
+        self.core_nbrs = cores.nbrs
+        if self.core_nbrs is None and self.cores_count > 0:
+            self.core_nbrs = AppendableNeighbors(self.points.data[self.core_indices], n_jobs=n_jobs,
+                                                 backend=neighbors_backend)
+
+        # the (cluster, point) entries of the membership and the primary labels
+        self.membership_clusters, self.membership_points = [np.array(entries) for entries in
+                                                            membership_entries(membership)]
+        self.entries_count = len(self.membership_clusters)
+        self.primary_labels = np.array(membership.labels if isinstance(membership, CompactMembership)
+                                       else membership_to_labels(membership))
+
+    def absorb(self, X, core_points_threshold=1, dvalue_threshold=1):
+        X = np.asarray(X, dtype=self.points.data.dtype)
+        if len(X) == 0:
+            return self
+        k = self.k
+        start = self.size
+        new_points = np.arange(start, start + len(X))
+        self.points.append(X)
+        self.size += len(X)
+
+        # the neighbors of the new points, and the older points which get one of them among their k neighbors
+        n_neighbors = min(2 * k + 1, self.size)
+        distances, indices = drop_self(*self.points.kneighbors(X, n_neighbors), rows=new_points)
+        candidates = indices < start
+        affected = np.unique(indices[candidates][distances[candidates] < self.distances[indices[candidates], k - 1]])
+
+        # replace the contributions of the affected points to the border values and add those of the new points
+        # (a batch away from the fitted points affects none of them)
+        self.border_values = append_rows(self.border_values, start, np.zeros(len(X)))
+        if len(affected) > 0:
+            affected_distances, affected_indices = drop_self(
+                *self.points.kneighbors(self.points.data[affected], k + 1), rows=affected
+            )
+            np.add.at(self.border_values, self.indices[affected],
+                      -exp_local_scaling_transform(self.distances[affected], self.indices[affected], k))
+            np.add.at(self.border_values, affected_indices,
+                      exp_local_scaling_transform(affected_distances, affected_indices, k))
+            self.distances[affected] = affected_distances
+            self.indices[affected] = affected_indices
+        np.add.at(self.border_values, indices[:, :k], exp_local_scaling_transform(distances[:, :k], indices[:, :k], k))
+        self.distances = append_rows(self.distances, start, distances[:, :k])
+        self.indices = append_rows(self.indices, start, indices[:, :k])
+
+        # new core points
+        to_core = self.border_values[new_points] > self.core_threshold
+        self.primary_labels = append_rows(self.primary_labels, start, np.ones(len(X), dtype=int) * -1)
+        if np.any(to_core):
+            self.add_cores(new_points[to_core])
+
+        # the rest of the new points form a border layer
+        border_points = new_points[~to_core]
+        if self.clusters_count > 0 and len(border_points) > 0:
+            nbrs_core_indices = self.core_nbrs.kneighbors(self.points.data[border_points], min(k, self.cores_count))[1]
+            most_cluster, border_to_core, border_rows, border_clusters = assign_regions(
+                self.core_clusters[nbrs_core_indices], self.clusters_count, core_points_threshold, dvalue_threshold
+            )
+            self.add_entries(np.concatenate((most_cluster, border_clusters)),
+                             np.concatenate((border_points, border_points[border_rows])))
+            self.primary_labels[border_points] = most_cluster
+            promoted = border_points[border_to_core]
+            self.link_thresholds = append_rows(self.link_thresholds, self.cores_count,
+                                               self.core_link_thresholds(promoted))
+            self.append_cores(promoted, most_cluster[border_to_core])
+        return self
+
+    def core_link_thresholds(self, points):
+        # the mean link threshold of the k nearest core points
+        if self.cores_count == 0:
+            return np.ones(len(points)) * self.dist_threshold
+        nbrs_core_indices = self.core_nbrs.kneighbors(self.points.data[points], min(self.k, self.cores_count))[1]
+        return np.fmin(self.link_thresholds[nbrs_core_indices].mean(axis=1), self.dist_threshold)
+
+    def append_cores(self, points, clusters):
+        self.core_indices = append_rows(self.core_indices, self.cores_count, points)
+        self.core_clusters = append_rows(self.core_clusters, self.cores_count, clusters)
+        self.cores_count += len(points)
+        if self.core_nbrs is None:
+            self.core_nbrs = AppendableNeighbors(self.points.data[points], n_jobs=self.n_jobs,
+                                                 backend=self.neighbors_backend)
+        else:
+            self.core_nbrs.append(self.points.data[points])
+
+    def add_entries(self, clusters, points):
+        self.membership_clusters = append_rows(self.membership_clusters, self.entries_count, clusters)
+        self.membership_points = append_rows(self.membership_points, self.entries_count, points)
+        self.entries_count += len(clusters)
+
+    def add_cores(self, points):
+        first_core = self.cores_count
+        self.link_thresholds = append_rows(self.link_thresholds, first_core, self.core_link_thresholds(points))
+        self.append_cores(points, np.ones(len(points), dtype=int) * -1)
+
+        # link the new core points to the core points within the link threshold of either one, skipping their
+        # nearest core point as merge_core_points does
+        n_neighbors = min(2 * self.k + 2, self.cores_count)
+        distances, indices = self.core_nbrs.kneighbors(self.points.data[points], n_neighbors)
+        new_cores = np.arange(first_core, self.cores_count)
+        distances, indices = drop_self(distances, indices, new_cores)
+        radii = np.maximum(self.link_thresholds[new_cores, np.newaxis], self.link_thresholds[indices])
+        linked = distances <= radii
+        linked[:, :1] = False
+        rows, cols = np.nonzero(linked)
+        link_new, link_cores = new_cores[rows], indices[rows, cols]
+
+        # sets of the clusters (first) and of the core points without a cluster, the fitted ones start in their
+        # merged sets of the fit (too small to become clusters) and the ones added since then on their own
+        clusters_count = self.clusters_count
+        core_clusters = self.core_clusters[:self.cores_count]
+        sets = union_find.UF(clusters_count + self.cores_count)
+        core_sets = np.array(self.core_indices[:self.cores_count])
+        fitted = core_sets < len(self.cluster_roots)
+        core_sets[fitted] = self.cluster_roots[core_sets[fitted]]
+        first_cores, core_sets = np.unique(core_sets, return_index=True, return_inverse=True)[1:]
+        nodes = np.where(core_clusters > -1, core_clusters, clusters_count + first_cores[core_sets])
+        sets.union(nodes[link_new], nodes[link_cores])
+        roots = sets.find(nodes)
+
+        # the clusters linked by the new core points are merged into the one with the smallest index, and the
+        # sets without a cluster which are large enough become new clusters
+        merged = np.unique(sets.find(np.arange(clusters_count)), return_inverse=True)[1]
+        merged_count = merged.max() + 1 if clusters_count > 0 else 0
+        new_sets, set_sizes = np.unique(roots[roots >= clusters_count], return_counts=True)
+        large_sets = new_sets[set_sizes >= max(self.min_cluster_size, 1)]
+        is_large = np.isin(roots, large_sets)
+        clusters = np.ones(self.cores_count, dtype=int) * -1
+        clusters[roots < clusters_count] = merged[roots[roots < clusters_count]]
+        clusters[is_large] = merged_count + np.searchsorted(large_sets, roots[is_large])
+
+        if merged_count < clusters_count:
+            self.membership_clusters[:self.entries_count] = merged[self.membership_clusters[:self.entries_count]]
+            labelled = np.flatnonzero(self.primary_labels[:self.size] > -1)
+            self.primary_labels[labelled] = merged[self.primary_labels[labelled]]
+        joined = (core_clusters == -1) & (clusters > -1)
+        self.add_entries(clusters[joined], self.core_indices[:self.cores_count][joined])
+        self.primary_labels[self.core_indices[:self.cores_count][joined]] = clusters[joined]
+        self.core_clusters[:self.cores_count] = clusters
+        self.clusters_count = merged_count + len(large_sets)
+
+    def core_regions(self):
+        return CoreRegions(self.core_indices[:self.cores_count], self.core_clusters[:self.cores_count],
+                           self.link_thresholds[:self.cores_count], self.clusters_count, self.core_nbrs)
+
+    def membership(self, membership_format="dense"):
+        return to_membership_format(self.membership_clusters[:self.entries_count],
+                                    self.membership_points[:self.entries_count], self.primary_labels[:self.size],
+                                    self.clusters_count, membership_format)
+
+
+# labels: the cluster of the core region of every point or the cluster most of its k-core neighbors belong to,
+# -1 for noise. the clusters of point i are clusters[indptr[i]:indptr[i + 1]]
+CompactMembership = namedtuple("CompactMembership", ["labels", "indptr", "clusters"])
+
+
+def to_membership_format(rows, cols, primary_labels, clusters_count, membership_format="dense"):
+    """Builds the membership of the points from its (cluster, point) entries.
+
+    membership_format is one of:
+    "dense" - (clusters, points) float array
+    "int8", "bool" - (clusters, points) array of the given type
+    "csr" - (clusters, points) scipy.sparse.csr_matrix of int8
+    "compact" - CompactMembership
+    """
+    shape = (clusters_count, len(primary_labels))
+    dense_types = {"dense": np.float64, "int8": np.int8, "bool": bool}
+    if membership_format in dense_types:
+        membership = np.zeros(shape, dtype=dense_types[membership_format])
+        membership[rows, cols] = 1
+        return membership
+
+    membership = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=shape)
+    membership.sum_duplicates()
+    membership.data[:] = 1
+    if membership_format == "csr":
+        return membership
+    if membership_format == "compact":
+        points_clusters = membership.T.tocsr()
+        points_clusters.sort_indices()
+        return CompactMembership(primary_labels, points_clusters.indptr, points_clusters.indices)
+    raise ValueError("Unknown membership format: %s" % membership_format)
+
+
+def membership_entries(membership):
+    """Returns the (clusters, points) entries of a membership in any of the formats of to_membership_format,
+    ordered by point and then by cluster.
+    """
+    if isinstance(membership, CompactMembership):
+        points = np.repeat(np.arange(len(membership.labels)), np.diff(membership.indptr))
+        return membership.clusters, points
+    clusters, points = membership.nonzero()
+    order = np.lexsort((clusters, points))
+    return clusters[order], points[order]
+
+
+def membership_to_labels(membership):
+    """Returns the final label of every point: the largest cluster it belongs to, -1 for outliers."""
+    points_count = len(membership.labels) if isinstance(membership, CompactMembership) else membership.shape[1]
+    clusters, points = membership_entries(membership)
+    labels = np.ones(points_count, dtype=int) * -1
+    np.maximum.at(labels, points, clusters)
+    return labels
+
+
+def neighbor_cluster_counts(nbrs_clusters):
+    """Returns the (row, cluster, count) of every cluster among the neighbors of every row, ordered by row and
+    then by cluster, given the (rows, k) clusters of the neighbors (-1 for neighbors without a cluster).
+    """
+    rows_count, k = nbrs_clusters.shape
+    rows = np.repeat(np.arange(rows_count), k)
+    clusters = np.sort(nbrs_clusters, axis=1).ravel()
+    # the first neighbor of every run of equal clusters in a row
+    firsts = np.ones(len(clusters), dtype=bool)
+    firsts[1:] = (clusters[1:] != clusters[:-1]) | (rows[1:] != rows[:-1])
+    firsts = np.flatnonzero(firsts)
+    counts = np.diff(np.append(firsts, len(clusters)))
+    has_cluster = clusters[firsts] > -1
+    return rows[firsts][has_cluster], clusters[firsts][has_cluster], counts[has_cluster]
+
+
+def estimate_lambda(data, k, n_jobs=None, nbrs_cache=None):
     '''
     Parameters
     ----------
     data
     k
+    nbrs_cache : a NeighborCache of data with at least k neighbors, used instead of a new kNN computation
 
     Returns
     -------
 
     '''
-    nbrs = NearestNeighbors(n_neighbors=k).fit(data)
-    distances, indices = nbrs.kneighbors()
+    if nbrs_cache is not None:
+        nbrs_cache.check_data(data)
+        distances, indices = nbrs_cache.kneighbors(k)
+    else:
+        nbrs = NearestNeighbors(n_neighbors=k, n_jobs=n_jobs).fit(data)
+        distances, indices = nbrs.kneighbors()
 
     all_dists = distances.flatten()
     return np.mean(all_dists) + np.std(all_dists)
 
 
 def union_find_to_lists(uf):
-    list_lists = []
-    reps_to_sets = {}
-
-    for i in range(len(uf._id)):
-        r = uf.find(i)
-        if r not in reps_to_sets:
-            reps_to_sets[r] = len(list_lists)
-            list_lists.append([i])
-        else:
-            list_lists[reps_to_sets[r]].append(i)
-
-    return list_lists
+    return [l.tolist() for l in uf.components()]
 
 
 def uf_to_associations_map(uf, core_points, original_indices):
-    reps_items = {}
-    reps_to_core = {}
-
-    for original_index in original_indices:
-        r = uf.find(original_index)
-        reps_to_core[r] = original_index
+    roots = uf.find_all()
 
-    for i in range(len(uf._id)):
-        r = uf.find(i)
+    # every set is represented by its last core point, or by its smallest item if it has no core points
+    reps_to_core = np.arange(len(roots))
+    core_roots = roots[original_indices][::-1]
+    _, last_cores = np.unique(core_roots, return_index=True)
+    reps_to_core[core_roots[last_cores]] = np.asarray(original_indices)[::-1][last_cores]
 
-        if r not in reps_to_core:
-            reps_to_core[r] = i
-
-        k = reps_to_core[r]
-        if k not in reps_items:
-            reps_items[k] = []
-        reps_items[k].append(i)
+    reps_items = {}
+    for items in uf.components():
+        reps_items[int(reps_to_core[items[0]])] = items.tolist()
 
     return reps_items
 
 
-def merge_core_points(core_points, link_thresholds, original_indices, cluster_sets, verbose=False):
-    t = StopWatch()
-    print(original_indices)
+def merge_core_points(core_points, link_thresholds, original_indices, cluster_sets, verbose=False, method="radius",
+                      n_jobs=None, neighbors_backend="exact", max_links=32, profiler=None):
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    if method == "radius":
+        return merge_core_points_radius(core_points, link_thresholds, original_indices, cluster_sets, verbose,
+                                        n_jobs=n_jobs, neighbors_backend=neighbors_backend, max_links=max_links,
+                                        profiler=profiler)
+
+    if verbose:
+        print(original_indices)
     try:
-        nbrs = NearestNeighbors(n_neighbors=len(core_points) - 1).fit(core_points, core_points)
+        nbrs = NearestNeighbors(n_neighbors=len(core_points) - 1, n_jobs=n_jobs).fit(core_points, core_points)
         distances, indices = nbrs.kneighbors()
     except Exception as err:
         if verbose:
             print("faiiled to find nearest neighbors for core points")
             print(err)
         return
-    t.t("Core points - after nn")
-    for original_index, ind_row, dist_row in zip(original_indices, indices, distances):
-        link_threshold = link_thresholds[original_index]
-        for i, d in zip(ind_row[1:], dist_row[1:]):
-            if d > link_threshold:
-                break
-            n_original_index = original_indices[i]
-            cluster_sets.union(original_index, n_original_index)
-    t.t("Core points - after merge")
+    profiler.stage("core merge - nn")
+    # link every core point to its neighbors (but the first one) within its link threshold
+    original_indices = np.asarray(original_indices)
+    within = distances[:, 1:] <= link_thresholds[original_indices][:, np.newaxis]
+    rows, cols = np.nonzero(within)
+    cluster_sets.union(original_indices[rows], original_indices[indices[:, 1:][rows, cols]])
+    profiler.stage("core merge - union")
+
+
+def merge_core_points_radius(core_points, link_thresholds, original_indices, cluster_sets, verbose=False,
+                             chunk_size=10000, n_jobs=None, neighbors_backend="exact", max_links=32, profiler=None):
+    """Same merge as the knn method of merge_core_points, computed from a sparse graph linking every
+    core point to the core points within its link threshold, so memory grows with the number of links
+    instead of with the squared number of core points.
+    With an approximate neighbors backend only the max_links nearest core points (found by the backend)
+    of every core point are linked.
+    """
+    if profiler is None:
+        profiler = Profiler(enabled=False)
+    original_indices = np.asarray(original_indices)
+    cores_count = len(core_points)
+    if cores_count < 2:
+        return
+
+    radii = link_thresholds[original_indices]
+    if neighbors_backend == "exact":
+        tree = KDTree(core_points)
+    else:
+        nbrs = make_neighbors(neighbors_backend, n_jobs).fit(core_points)
+        # the point itself and its nearest neighbor are skipped
+        n_neighbors = min(max_links + 2, cores_count)
+    profiler.stage("core merge - tree")
+
+    def links_block(start, stop):
+        if neighbors_backend == "exact":
+            indices = tree.query_radius(core_points[start:stop], r=radii[start:stop], sort_results=True,
+                                        return_distance=True)[0]
+            rows = np.repeat(np.arange(start, stop), [len(row) for row in indices])
+            cols = np.concatenate(indices)
+        else:
+            distances, indices = nbrs.kneighbors(core_points[start:stop], n_neighbors=n_neighbors)
+            rows, positions = np.nonzero(distances <= radii[start:stop, np.newaxis])
+            cols = indices[rows, positions]
+            rows = rows + start
+        # as in the knn method, skip the point itself and then its nearest neighbor
+        not_self = cols != rows
+        rows = rows[not_self]
+        cols = cols[not_self]
+        not_first = np.ones(len(rows), dtype=bool)
+        not_first[np.unique(rows, return_index=True)[1]] = False
+        return rows[not_first], cols[not_first]
+
+    link_rows, link_cols = zip(*map_blocks(links_block, cores_count, chunk_size, n_jobs))
+    link_rows = np.concatenate(link_rows)
+    link_cols = np.concatenate(link_cols)
+    graph = csr_matrix((np.ones(len(link_rows), dtype=bool), (link_rows, link_cols)),
+                       shape=(cores_count, cores_count))
+    components_count, labels = connected_components(graph, directed=True, connection='weak')
+    profiler.stage("core merge - components", links=len(link_rows))
+
+    # union every core point with the first core point of its component
+    first_cores = np.unique(labels, return_index=True)[1]
+    cluster_sets.union(original_indices, original_indices[first_cores[labels]])
+    profiler.stage("core merge - union")
 
 
 def border_peel_rknn_exp_transform_local(data, k, threshold, iterations, debug_output_dir=None,
                                          dist_threshold=3, link_dist_expansion_factor=3, precentile=0, verbose=True):
-    border_func = lambda data: rknn_with_distance_transform(data, k, exp_local_scaling_transform)
+    border_func = lambda data, nbrs=None: rknn_with_distance_transform(data, k, exp_local_scaling_transform, nbrs)
     threshold_func = lambda value: value > threshold
     return dynamic_3w(data, iterations, border_func, threshold_func,
                       plot_debug_output_dir=debug_output_dir, k=k, precentile=precentile,
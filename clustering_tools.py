@@ -1,4 +1,5 @@
 import itertools
+import warnings
 import numpy as np
 import matplotlib.pyplot as plt
 from collections import OrderedDict
@@ -12,36 +13,53 @@ from sklearn.cluster import AffinityPropagation, DBSCAN, MeanShift, estimate_ban
 from sklearn.neighbors import kneighbors_graph
 from sklearn import metrics
 from sklearn import preprocessing
+from M3W.border_tools import membership_to_labels
+from M3W.sweep import border_peel_sweep
 
 
-def read_data(filePath, seperator=',', has_labels=True):
+def read_data(filePath, seperator=',', has_labels=True, dtype=None, chunk_size=1000000):
     '''
     Parameters
     ----------
-    filePath
+    filePath : text file with a row per point, or an .npy file which is memory-mapped
     seperator
-    has_labels
+    has_labels : the last column holds the integer labels of the points
+    dtype : type of the returned data (e.g. np.float32), by default float64 for text files and the
+        stored type for .npy files
+    chunk_size : number of text lines parsed at once
     Returns
     -------
+    data, labels (labels is np.array(None) without labels)
     '''
-    with open(filePath) as handle:
-        data = []
-        labels = None
-        if (has_labels):
-            labels = []
-
-        for line in handle:
-            line = line.rstrip()
-            if len(line) == 0:
+    if filePath.endswith(".npy"):
+        rows = np.load(filePath, mmap_mode='r')
+        data = rows[:, :-1] if has_labels else rows
+        if dtype is not None and data.dtype != dtype:
+            data = data.astype(dtype)
+        return data, np.array(rows[:, -1].astype(int) if has_labels else None)
+
+    if dtype is None:
+        dtype = np.float64
+
+    data_chunks = []
+    labels_chunks = []
+    with open(filePath) as handle, warnings.catch_warnings():
+        # loadtxt warns about chunks with empty lines only
+        warnings.simplefilter("ignore", UserWarning)
+        while True:
+            lines = list(itertools.islice(handle, chunk_size))
+            if len(lines) == 0:
+                break
+            chunk = np.loadtxt(lines, delimiter=seperator, ndmin=2)
+            if len(chunk) == 0:
                 continue
-            line_parts = line.split(seperator)
-            row = [float(i) for i in line_parts[:len(line_parts) - 1]]
-            data.append(row)
-            if (has_labels):
-                label = int(line_parts[-1])
-                labels.append(label)
+            if has_labels:
+                labels_chunks.append(chunk[:, -1].astype(int))
+                chunk = chunk[:, :-1]
+            data_chunks.append(chunk.astype(dtype, copy=False))
 
-        return np.ndarray(shape=(len(data), len(data[0])), buffer=np.array(data)), np.array(labels)
+    labels = np.concatenate(labels_chunks) if has_labels else None
+    return np.concatenate(data_chunks), np.array(labels)
 
 
 # read arff file:
@@ -72,6 +90,47 @@ def save_data(file_path, data, labels):
             handle.write(line + "\n")
 
 
+def save_labels(file_path, labels, output_format="csv"):
+    """Saves one label per point as csv lines, an .npy array or raw little endian int32 values ("bin")."""
+    labels = np.asarray(labels)
+    if output_format == "csv":
+        np.savetxt(file_path, labels, fmt="%d")
+    elif output_format == "npy":
+        np.save(file_path, labels)
+    elif output_format == "bin":
+        labels.astype("<i4").tofile(file_path)
+    else:
+        raise ValueError("Unknown output format: %s" % output_format)
+
+
+def save_memberships(file_path, clusters, points, points_count, output_format="csv"):
+    """Saves all the clusters of every point given the (cluster, point) membership entries ordered by point.
+
+    csv - a line per point with its comma separated clusters (-1 for outliers)
+    npy, bin - (entries, 2) array of (point, cluster) rows, as .npy or raw little endian int32 values
+    """
+    if output_format == "csv":
+        # outliers get a -1 entry, and entries are followed by a comma unless they end the line of their point
+        outliers = np.setdiff1d(np.arange(points_count), points)
+        clusters = np.concatenate((clusters, -np.ones(len(outliers), dtype=int)))
+        points = np.concatenate((points, outliers))
+        order = np.argsort(points, kind='stable')
+        clusters = clusters[order]
+        points = points[order]
+        separators = np.where(np.append(points[1:] != points[:-1], True), "\n", ",")
+        with open(file_path, "w") as handle:
+            handle.write("".join(np.char.add(clusters.astype(str), separators)))
+        return
+
+    pairs = np.column_stack((points, clusters))
+    if output_format == "npy":
+        np.save(file_path, pairs)
+    elif output_format == "bin":
+        pairs.astype("<i4").tofile(file_path)
+    else:
+        raise ValueError("Unknown output format: %s" % output_format)
+
+
 def load_from_file_or_data(obj, seperator=',', dim=2, hasLabels=False):
     if (type(obj) is str):
         return read_data(obj, seperator=seperator, dim=dim, hasLabels=hasLabels)
@@ -687,7 +746,7 @@ class MethodsEvaluation:
         self.sorted_by = None
 
     def evaulate_method(self, X, labels_true, labels, name, params, show_plt=False):
-        if (not self.scores_table.has_key(name)):
+        if name not in self.scores_table:
             self.scores_table[name] = []
 
         scores = [evaulations_dict[m](X, labels_true, labels, name, params) for m in EvaluationFields]
@@ -704,6 +763,17 @@ class MethodsEvaluation:
             params_str = "_".join(["%s=%s" % (k, format_param(j)) for k, j in zip(params_range, p)])
             self.evaulate_method(data, true_labels, clusters, method_name, params_str, show_plt=False)
 
+    def border_peel_params_range_evaluation(self, data, true_labels, base_params, params_range, method_name,
+                                            n_jobs=None):
+        """cluster_params_range_evaluation() of BorderPeel (base_params and params_range are its parameters),
+        the settings which differ only in the assignment parameters share their peeling (see
+        sweep.border_peel_sweep) and the independent settings run in n_jobs worker processes.
+        """
+        for params, membership in border_peel_sweep(data, base_params, params_range, n_jobs=n_jobs):
+            params_str = "_".join(["%s=%s" % (k, format_param(params[k])) for k in params_range])
+            self.evaulate_method(data, true_labels, membership_to_labels(membership), method_name, params_str,
+                                 show_plt=False)
+
     # for each method, leave only the top n scores
     # this will also sort the list
     def filter_top_n_by_field_for_method(self, evaluation_field, n):
@@ -0,0 +1,699 @@
+from sklearn.base import clone
+from sklearn.neighbors import NearestNeighbors, KDTree, BallTree
+from sklearn.utils import check_random_state
+from joblib import Parallel, delayed, effective_n_jobs
+from M3W.numba_kernels import first_neighbors_kernel
+import json
+import numpy as np
+import os
+import sklearn
+import tempfile
+
+
+def new_array(shape, dtype, directory=None):
+    """np.empty(), or a disk backed np.memmap in a new file under directory when it is given.
+
+    The file is unlinked once it is mapped, so its disk space is freed with the array (where open files
+    can't be removed, e.g. on Windows, the file is left in directory).
+    """
+    if directory is None:
+        return np.empty(shape, dtype=dtype)
+    handle, path = tempfile.mkstemp(suffix=".dat", dir=directory)
+    os.close(handle)
+    array = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    return array
+
+
+def gather_rows(data, rows, dtype=np.float64, directory=None, block_size=65536):
+    """data[rows] as a new_array() of dtype, copied in blocks of block_size rows."""
+    gathered = new_array((len(rows),) + data.shape[1:], dtype, directory)
+    for start in range(0, len(rows), block_size):
+        gathered[start:start + block_size] = data[rows[start:start + block_size]]
+    return gathered
+
+
+def map_blocks(func, rows_count, block_size=65536, n_jobs=None):
+    """Calls func(start, stop) for the blocks of rows_count rows and returns the results in order.
+
+    With n_jobs (joblib semantics, -1 for all the cores) the blocks are split among the jobs and run on
+    a thread pool, NumPy and the sklearn neighbor trees release the GIL in their heavy loops.
+    """
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs > 1:
+        block_size = max(1, min(block_size, -(-rows_count // n_jobs)))
+    blocks = [(start, min(start + block_size, rows_count)) for start in range(0, rows_count, block_size)]
+    if n_jobs == 1 or len(blocks) <= 1:
+        return [func(start, stop) for start, stop in blocks]
+    return Parallel(n_jobs=n_jobs, prefer="threads")(delayed(func)(start, stop) for start, stop in blocks)
+
+
+def make_neighbors(backend="exact", n_jobs=None):
+    """Returns a new (unfitted) neighbors model of the backend: "exact" for NearestNeighbors, "rp_forest" for an
+    RPForestNeighbors with the default parameters, or a clone of a given model with the fit(X) and
+    kneighbors(X, n_neighbors) methods of NearestNeighbors (e.g. a tuned RPForestNeighbors).
+    """
+    if isinstance(backend, str):
+        if backend == "exact":
+            return NearestNeighbors(n_jobs=n_jobs)
+        if backend == "rp_forest":
+            return RPForestNeighbors()
+        raise ValueError("Unknown neighbors backend: %s" % backend)
+    return clone(backend, safe=False)
+
+
+def drop_self(distances, indices, rows):
+    """Drops every point from its own neighbors (with n_neighbors + 1 columns), as NearestNeighbors.kneighbors()
+    does when it is called without query points: when a point is not found among its neighbors (e.g. when it
+    has duplicates) its first neighbor is dropped instead.
+    """
+    keep = indices != rows[:, np.newaxis]
+    keep[keep.all(axis=1), 0] = False
+    shape = (len(rows), indices.shape[1] - 1)
+    return distances[keep].reshape(shape), indices[keep].reshape(shape)
+
+
+def kneighbors_blocks(nbrs, data, n_neighbors, directory=None, block_size=65536, n_jobs=None):
+    """nbrs.kneighbors() of a model fitted on data, computed in blocks of rows into new_array()s."""
+    distances = new_array((len(data), n_neighbors), np.float64, directory)
+    indices = new_array((len(data), n_neighbors), np.intp, directory)
+
+    def kneighbors_block(start, stop):
+        block_distances, block_indices = nbrs.kneighbors(data[start:stop], n_neighbors=n_neighbors + 1)
+        distances[start:stop], indices[start:stop] = drop_self(block_distances, block_indices,
+                                                               np.arange(start, stop))
+
+    map_blocks(kneighbors_block, len(data), block_size, n_jobs)
+    return distances, indices
+
+
+class NeighborCache:
+    """A nearest neighbors model of a data set with the table of the neighbors of all its points, computed once
+    and shared by the stages which need them (lambda estimation, the rknn neighbors and the association table).
+
+    kneighbors() returns the leading columns of the table, as NearestNeighbors.kneighbors() without query
+    points. With a directory the table is kept in disk backed arrays. backend is a make_neighbors() backend.
+    """
+
+    def __init__(self, data, n_neighbors, directory=None, block_size=65536, n_jobs=None, backend="exact"):
+        self.data = data
+        self.n_neighbors = min(n_neighbors, len(data) - 1)
+        self.nbrs = make_neighbors(backend, n_jobs).fit(data)
+        self.distances, self.indices = kneighbors_blocks(self.nbrs, data, self.n_neighbors, directory, block_size,
+                                                         n_jobs)
+
+    def check_data(self, data):
+        if len(data) != len(self.data):
+            raise ValueError("The neighbor cache was computed for %d points, got %d points"
+                             % (len(self.data), len(data)))
+
+    def kneighbors(self, n_neighbors):
+        if n_neighbors > self.n_neighbors:
+            raise ValueError("Expected n_neighbors <= %d (the neighbor cache width), got %d"
+                             % (self.n_neighbors, n_neighbors))
+        return self.distances[:, :n_neighbors], self.indices[:, :n_neighbors]
+
+
+class GrowingNeighbors:
+    """Nearest neighbors table over a fixed data set whose rows are grown on demand.
+
+    Every row starts with `n_neighbors` neighbors. A row is re-queried with twice as many
+    neighbors only when a scan walks past its last stored neighbor while still inside the
+    scan radius, so memory stays linear in the number of points instead of holding all
+    (n - 1) neighbors of every point. With a directory the table is kept in disk backed arrays.
+    With a NeighborCache its model and table are used instead (the table is only read).
+    """
+
+    def __init__(self, data, n_neighbors, directory=None, block_size=65536, n_jobs=None, cache=None):
+        self.data = data
+        self.max_neighbors = len(data) - 1
+        n_neighbors = min(n_neighbors, self.max_neighbors)
+        if cache is not None:
+            cache.check_data(data)
+            self.nbrs = cache.nbrs
+            self.distances, self.indices = cache.kneighbors(n_neighbors)
+        else:
+            self.nbrs = NearestNeighbors(n_neighbors=n_neighbors).fit(data)
+            self.distances, self.indices = kneighbors_blocks(self.nbrs, data, n_neighbors, directory, block_size,
+                                                             n_jobs)
+        self.grown_rows = {}
+
+    def row(self, index):
+        if index in self.grown_rows:
+            return self.grown_rows[index]
+        return self.indices[index], self.distances[index]
+
+    def grow(self, index):
+        indices, distances = self.row(index)
+        n_neighbors = min(2 * len(indices), self.max_neighbors)
+        if n_neighbors <= len(indices):
+            return None
+
+        distances, indices = drop_self(*self.nbrs.kneighbors(self.data[index:index + 1], n_neighbors=n_neighbors + 1),
+                                       rows=np.array([index]))
+        self.grown_rows[index] = (indices[0], distances[0])
+        return self.grown_rows[index]
+
+    def first_neighbor(self, index, radius, candidates):
+        """Returns (neighbor index, distance) of the nearest neighbor of `index` which is set in
+        `candidates` and lies within `radius`, or (-1, -1) if there is no such neighbor.
+        """
+        start = 0
+        while True:
+            indices, distances = self.row(index)
+            for nig_index, nig_dist in zip(indices[start:], distances[start:]):
+                if nig_dist > radius:
+                    return -1, -1
+                if candidates[nig_index]:
+                    return nig_index, nig_dist
+
+            start = len(indices)
+            if self.grow(index) is None:
+                return -1, -1
+
+    def first_neighbors(self, rows, radii, candidates, backend="numpy"):
+        """Batched first_neighbor() for all the given rows, returns the neighbor indices and distances."""
+        rows = np.asarray(rows, dtype=int)
+        link_indices = np.full(len(rows), -1)
+        link_distances = np.full(len(rows), -1.0)
+
+        indices = self.indices[rows]
+        distances = self.distances[rows]
+        if backend == "numba":
+            exhausted = first_neighbors_kernel(indices, distances, np.asarray(radii, dtype=np.float64), candidates,
+                                               link_indices, link_distances)
+        else:
+            # distances are sorted, so the neighbors within the radius are a prefix of each row
+            within = distances <= radii[:, np.newaxis]
+            valid = within & (candidates[indices] != 0)
+            found = valid.any(axis=1)
+            first = valid.argmax(axis=1)[found]
+            link_indices[found] = indices[found, first]
+            link_distances[found] = distances[found, first]
+            exhausted = ~found & within[:, -1]
+
+        # rows which are scanned up to the last stored neighbor need their grown rows
+        for i in np.flatnonzero(exhausted):
+            link_indices[i], link_distances[i] = self.first_neighbor(rows[i], radii[i], candidates)
+
+        return link_indices, link_distances
+
+
+def _gather_rows(indptr, values, keys):
+    # concatenation of values[indptr[key]:indptr[key + 1]] for all keys
+    starts = indptr[keys]
+    lengths = indptr[keys + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return values[offsets + np.arange(lengths.sum())]
+
+
+class IncrementalNeighbors:
+    """k nearest neighbors among the points of a data set which were not removed yet.
+
+    Rows are stored sorted by distance with up to k spare neighbors. When points are removed
+    only the rows which referenced them are repaired: removed neighbors are dropped from the
+    row, and rows left with less than k neighbors are re-queried, so the cost of a removal
+    scales with the number of removed points and not with the number of remaining ones.
+    kneighbors() mimics NearestNeighbors.kneighbors() of a model fitted on the remaining points.
+    With a directory the rows, the reverse references and the kneighbors() results are kept in disk backed
+    arrays, and are built in blocks of block_size rows. With a NeighborCache the rows start as a copy of
+    its table.
+    """
+
+    def __init__(self, data, n_neighbors, directory=None, block_size=65536, n_jobs=None, cache=None):
+        self.data = data
+        self.n_neighbors = n_neighbors
+        self.directory = directory
+        self.block_size = block_size
+        self.alive = np.ones(len(data), dtype=bool)
+        self.alive_count = len(data)
+        width = min(2 * n_neighbors, len(data) - 1)
+        if cache is not None:
+            cache.check_data(data)
+            self.nbrs = cache.nbrs
+            cache_distances, cache_indices = cache.kneighbors(width)
+            self.distances = new_array(cache_distances.shape, np.float64, directory)
+            self.indices = new_array(cache_indices.shape, np.intp, directory)
+            self.distances[:] = cache_distances
+            self.indices[:] = cache_indices
+        else:
+            self.nbrs = NearestNeighbors(n_neighbors=width, n_jobs=n_jobs).fit(data)
+            self.distances, self.indices = kneighbors_blocks(self.nbrs, data, width, directory, block_size, n_jobs)
+        self.counts = np.full(len(data), width)
+
+        # rows referencing each point (in row order), rows which are re-queried later add their new neighbors
+        # to the extra arrays
+        references_count = np.zeros(len(data), dtype=np.intp)
+        for start in range(0, len(data), block_size):
+            np.add.at(references_count, self.indices[start:start + block_size].ravel(), 1)
+        self.referenced_by_indptr = np.concatenate(([0], np.cumsum(references_count)))
+        self.referenced_by = new_array(self.indices.size, np.intp, directory)
+        filled = self.referenced_by_indptr[:-1].copy()
+        for start in range(0, len(data), block_size):
+            block = self.indices[start:start + block_size].ravel()
+            order = np.argsort(block, kind='stable')
+            referenced = block[order]
+            # the rank of every reference among the references to the same point in the block
+            ranks = np.arange(len(referenced)) - np.searchsorted(referenced, referenced)
+            self.referenced_by[filled[referenced] + ranks] = start + order // width
+            np.add.at(filled, referenced, 1)
+        self.extra_referenced = np.zeros(0, dtype=int)
+        self.extra_referenced_by = np.zeros(0, dtype=int)
+
+    def kneighbors(self, n_neighbors=None):
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        if n_neighbors > self.n_neighbors:
+            raise ValueError("Expected n_neighbors <= %d, got %d" % (self.n_neighbors, n_neighbors))
+
+        n_neighbors = min(n_neighbors, self.alive_count - 1)
+        rows = np.flatnonzero(self.alive)
+        positions = np.cumsum(self.alive) - 1
+        distances = new_array((len(rows), n_neighbors), np.float64, self.directory)
+        indices = new_array((len(rows), n_neighbors), np.intp, self.directory)
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start:start + self.block_size]
+            distances[start:start + self.block_size] = self.distances[block, :n_neighbors]
+            indices[start:start + self.block_size] = positions[self.indices[block, :n_neighbors]]
+        return distances, indices
+
+    def remove(self, removed):
+        removed = np.asarray(removed, dtype=int)
+        self.alive[removed] = False
+        self.alive_count = np.count_nonzero(self.alive)
+
+        rows = np.concatenate((
+            _gather_rows(self.referenced_by_indptr, self.referenced_by, removed),
+            self.extra_referenced_by[np.isin(self.extra_referenced, removed)]
+        ))
+        rows = np.unique(rows)
+        self.repair(rows[self.alive[rows]])
+
+    def repair(self, rows):
+        width = self.indices.shape[1]
+        indices = self.indices[rows]
+        distances = self.distances[rows]
+        valid = self.alive[indices] & (np.arange(width) < self.counts[rows, np.newaxis])
+
+        # move the remaining neighbors to the front of the row, keeping their order
+        order = np.argsort(~valid, axis=1, kind='stable')
+        self.indices[rows] = np.take_along_axis(indices, order, axis=1)
+        self.distances[rows] = np.take_along_axis(distances, order, axis=1)
+        self.counts[rows] = np.count_nonzero(valid, axis=1)
+
+        needed = min(self.n_neighbors, self.alive_count - 1)
+        short_rows = rows[self.counts[rows] < needed]
+        if len(short_rows) > 0:
+            self.requery(short_rows, needed)
+
+    def requery(self, rows, needed):
+        width = self.indices.shape[1]
+        n_query = min(2 * width, len(self.data))
+        while len(rows) > 0:
+            distances, indices = self.nbrs.kneighbors(self.data[rows], n_neighbors=n_query)
+            valid = self.alive[indices] & (indices != rows[:, np.newaxis])
+            found = np.count_nonzero(valid, axis=1)
+            done = (found >= needed) | (n_query == len(self.data))
+
+            done_rows = rows[done]
+            order = np.argsort(~valid[done], axis=1, kind='stable')[:, :width]
+            self.indices[done_rows] = np.take_along_axis(indices[done], order, axis=1)
+            self.distances[done_rows] = np.take_along_axis(distances[done], order, axis=1)
+            self.counts[done_rows] = np.minimum(found[done], width)
+
+            self.extra_referenced = np.concatenate((self.extra_referenced, self.indices[done_rows].ravel()))
+            self.extra_referenced_by = np.concatenate((self.extra_referenced_by, np.repeat(done_rows, width)))
+
+            rows = rows[~done]
+            n_query = min(2 * n_query, len(self.data))
+
+
+class PeeledNeighbors:
+    """The k nearest peeled points of every remaining point of a data set, as points are peeled in batches.
+
+    Every peeled batch is searched on its own: the remaining points are queried for their nearest point of
+    the batch first, and only the rows where it is closer than the current k-th neighbor are queried for k
+    neighbors in the batch and merged. The rows are available (ready) once at least k points were peeled.
+    With a directory the rows are kept in disk backed arrays. backend is a make_neighbors() backend.
+    """
+
+    def __init__(self, data, n_neighbors, directory=None, block_size=65536, n_jobs=None, backend="exact"):
+        self.data = data
+        self.n_neighbors = n_neighbors
+        self.directory = directory
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.peeled_count = 0
+        self.pending = []
+        self.distances = None
+        self.indices = None
+
+    @property
+    def ready(self):
+        return self.indices is not None
+
+    def add(self, peeled, remaining):
+        """Add a batch of peeled points and update the rows of the remaining points."""
+        peeled = np.asarray(peeled, dtype=int)
+        remaining = np.asarray(remaining, dtype=int)
+        self.peeled_count += len(peeled)
+        initial = not self.ready
+        if initial:
+            # the batches are collected until there are enough points for full rows
+            self.pending.append(peeled)
+            if self.peeled_count < self.n_neighbors:
+                return
+            peeled = np.concatenate(self.pending)
+            self.pending = None
+            shape = (len(self.data), self.n_neighbors)
+            self.distances = new_array(shape, np.float64, self.directory)
+            self.indices = new_array(shape, np.intp, self.directory)
+        elif len(peeled) == 0:
+            return
+
+        nbrs = make_neighbors(self.backend, self.n_jobs).fit(self.data[peeled])
+        n_neighbors = min(self.n_neighbors, len(peeled))
+
+        if initial:
+            changed = remaining
+        else:
+            def nearest_changed(start, stop):
+                rows = remaining[start:stop]
+                distances, _ = nbrs.kneighbors(self.data[rows], n_neighbors=1)
+                return rows[distances[:, 0] < self.distances[rows, -1]]
+
+            changed = np.concatenate(
+                [np.zeros(0, dtype=int)] + map_blocks(nearest_changed, len(remaining), self.block_size, self.n_jobs)
+            )
+
+        def merge_block(start, stop):
+            rows = changed[start:stop]
+            distances, indices = nbrs.kneighbors(self.data[rows], n_neighbors=n_neighbors)
+            indices = peeled[indices]
+            if not initial:
+                distances = np.concatenate((self.distances[rows], distances), axis=1)
+                indices = np.concatenate((self.indices[rows], indices), axis=1)
+                order = np.argsort(distances, axis=1, kind='stable')[:, :self.n_neighbors]
+                distances = np.take_along_axis(distances, order, axis=1)
+                indices = np.take_along_axis(indices, order, axis=1)
+            self.distances[rows] = distances
+            self.indices[rows] = indices
+
+        map_blocks(merge_block, len(changed), self.block_size, self.n_jobs)
+
+
+class AppendableNeighbors:
+    """k nearest neighbors queries over a set of points which only grows.
+
+    The points are split into a base model and a delta model over the points appended since the
+    base was fitted. Appending only refits the (small) delta, and the delta is merged into the
+    base once it grows over `rebuild_ratio` of the base. Queries search both and merge the results,
+    so they return the same neighbors as a model fitted on all the points. Neighbor indices are
+    the positions of the points in insertion order. backend is a make_neighbors() backend.
+    base_nbrs is a model already fitted on data (e.g. from load_neighbors), data is then used as is
+    (appending copies it first). With a directory the points are kept in disk backed arrays.
+    """
+
+    def __init__(self, data, rebuild_ratio=0.5, n_jobs=None, backend="exact", base_nbrs=None, directory=None):
+        self.rebuild_ratio = rebuild_ratio
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.directory = directory
+        self.rebuilds = 0
+        if base_nbrs is None:
+            self.data = gather_rows(data, np.arange(len(data)), data.dtype, directory) if directory is not None \
+                else np.array(data)
+            self.size = len(self.data)
+            self.fit_base()
+        else:
+            self.data = np.asarray(data)
+            self.size = self.base_size = len(self.data)
+            self.base_nbrs = base_nbrs
+            self.delta_nbrs = None
+
+    def __len__(self):
+        return self.size
+
+    def fit_base(self):
+        self.base_size = self.size
+        self.base_nbrs = make_neighbors(self.backend, self.n_jobs).fit(self.data[:self.size])
+        self.delta_nbrs = None
+        self.rebuilds += 1
+
+    def append(self, points):
+        points = np.asarray(points)
+        if len(points) == 0:
+            return
+
+        new_size = self.size + len(points)
+        if new_size > len(self.data):
+            capacity = max(new_size, 2 * len(self.data))
+            data = new_array((capacity,) + self.data.shape[1:], self.data.dtype, self.directory)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:new_size] = points
+        self.size = new_size
+
+        if self.size - self.base_size > self.rebuild_ratio * self.base_size:
+            self.fit_base()
+        else:
+            self.delta_nbrs = make_neighbors(self.backend, self.n_jobs).fit(self.data[self.base_size:self.size])
+
+    def kneighbors(self, X, n_neighbors):
+        if n_neighbors > self.size:
+            raise ValueError("Expected n_neighbors <= n_samples, but n_samples = %d, n_neighbors = %d"
+                             % (self.size, n_neighbors))
+
+        distances, indices = self.base_nbrs.kneighbors(X, n_neighbors=min(n_neighbors, self.base_size))
+        if self.delta_nbrs is None:
+            return distances, indices
+
+        delta_distances, delta_indices = self.delta_nbrs.kneighbors(
+            X, n_neighbors=min(n_neighbors, self.size - self.base_size)
+        )
+        distances = np.concatenate((distances, delta_distances), axis=1)
+        indices = np.concatenate((indices, delta_indices + self.base_size), axis=1)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :n_neighbors]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+class RPForestNeighbors:
+    """Approximate k nearest neighbors with a forest of random projection trees.
+
+    Every tree splits its nodes at the median of the projections of their points on the difference of two
+    random points of the node, down to leaves of at most leaf_size points. A query takes the points of its
+    leaf in every tree as candidates and ranks them by their exact distances, so more trees and larger
+    leaves give a higher recall at a higher cost. Queries with less than n_neighbors candidates fall back
+    to a brute force search. fit() and kneighbors(X, n_neighbors) follow NearestNeighbors.
+    """
+
+    def __init__(self, n_trees=16, leaf_size=64, random_state=0):
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.random_state = random_state
+
+    def fit(self, X):
+        self.data = X
+        self.data_norms = np.einsum('ij,ij->i', X, X)
+        self.brute_nbrs = None
+        random_state = check_random_state(self.random_state)
+        depth = int(np.ceil(np.log2(len(X) / self.leaf_size))) if len(X) > self.leaf_size else 0
+        self.trees = [self._build_tree(random_state, depth) for _ in range(self.n_trees)]
+        return self
+
+    def _build_tree(self, random_state, depth):
+        data = self.data
+        nodes = np.zeros(len(data), dtype=np.intp)
+        directions = []
+        thresholds = []
+        for level in range(depth):
+            sizes = np.bincount(nodes, minlength=2 ** level)
+            starts = np.cumsum(sizes) - sizes
+            order = np.argsort(nodes, kind='stable')
+
+            # the split direction of every node is the difference of two of its points
+            picks = [order[np.minimum(starts + (random_state.random_sample(len(sizes)) * sizes).astype(np.intp),
+                                      len(data) - 1)] for _ in range(2)]
+            level_directions = data[picks[0]] - data[picks[1]]
+            projections = _project(data, level_directions, nodes)
+
+            # the first half of every node (by projection) goes to its left child
+            order = np.lexsort((projections, nodes))
+            ranks = np.empty(len(data), dtype=np.intp)
+            ranks[order] = np.arange(len(data)) - np.repeat(starts, sizes)
+            right = ranks >= (sizes // 2)[nodes]
+
+            # queries are routed by the middle of the two halves, nodes without a left half send all to the right
+            sorted_projections = projections[order]
+            middle = starts + sizes // 2
+            has_left = sizes // 2 > 0
+            level_thresholds = np.full(len(sizes), -np.inf)
+            level_thresholds[has_left] = (sorted_projections[middle[has_left] - 1] +
+                                          sorted_projections[middle[has_left]]) / 2
+
+            directions.append(level_directions)
+            thresholds.append(level_thresholds)
+            nodes = 2 * nodes + right
+
+        # the points of every leaf, padded with -1
+        leaf_sizes = np.bincount(nodes, minlength=2 ** depth)
+        order = np.argsort(nodes, kind='stable')
+        members = np.full((len(leaf_sizes), leaf_sizes.max()), -1, dtype=np.intp)
+        members[nodes[order], np.arange(len(data)) - np.repeat(np.cumsum(leaf_sizes) - leaf_sizes, leaf_sizes)] = order
+        return directions, thresholds, members
+
+    def kneighbors(self, X, n_neighbors):
+        X = np.asarray(X)
+        norms = np.einsum('ij,ij->i', X, X)
+
+        # squared distances to the points of the leaf of every tree, with a matrix product per leaf
+        candidates = []
+        candidate_distances = []
+        for directions, thresholds, members in self.trees:
+            nodes = np.zeros(len(X), dtype=np.intp)
+            for level_directions, level_thresholds in zip(directions, thresholds):
+                nodes = 2 * nodes + (_project(X, level_directions, nodes) > level_thresholds[nodes])
+            distances = np.full((len(X), members.shape[1]), np.inf)
+            order = np.argsort(nodes, kind='stable')
+            leaves, starts = np.unique(nodes[order], return_index=True)
+            for leaf, start, stop in zip(leaves, starts, np.append(starts[1:], len(X))):
+                rows = order[start:stop]
+                leaf_members = members[leaf][members[leaf] >= 0]
+                distances[rows, :len(leaf_members)] = (norms[rows, np.newaxis] + self.data_norms[leaf_members] -
+                                                       2 * np.dot(X[rows], self.data[leaf_members].T))
+            candidates.append(members[nodes])
+            candidate_distances.append(distances)
+        candidates = np.concatenate(candidates, axis=1)
+        distances = np.concatenate(candidate_distances, axis=1)
+
+        # a point repeats at most once per tree, so the nearest n_neighbors points are among the
+        # n_neighbors * n_trees nearest candidates
+        keep = n_neighbors * len(self.trees)
+        if keep < candidates.shape[1]:
+            nearest = np.argpartition(distances, keep - 1, axis=1)[:, :keep]
+            candidates = np.take_along_axis(candidates, nearest, axis=1)
+            distances = np.take_along_axis(distances, nearest, axis=1)
+
+        # drop the repeated candidates and keep the nearest ones, with their exact distances
+        order = np.argsort(candidates, axis=1, kind='stable')
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        distances = np.take_along_axis(distances, order, axis=1)
+        distances[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = np.inf
+        distances[candidates < 0] = np.inf
+        short = np.count_nonzero(np.isfinite(distances), axis=1) < n_neighbors
+
+        result_distances = np.empty((len(X), n_neighbors))
+        result_indices = np.empty((len(X), n_neighbors), dtype=np.intp)
+        if not short.all():
+            nearest = np.argsort(distances[~short], axis=1, kind='stable')[:, :n_neighbors]
+            indices = np.take_along_axis(candidates[~short], nearest, axis=1)
+            exact_distances = _candidate_distances(X[~short], self.data, indices)
+            order = np.argsort(exact_distances, axis=1, kind='stable')
+            result_distances[~short] = np.take_along_axis(exact_distances, order, axis=1)
+            result_indices[~short] = np.take_along_axis(indices, order, axis=1)
+        if short.any():
+            if self.brute_nbrs is None:
+                self.brute_nbrs = NearestNeighbors(algorithm="brute").fit(self.data)
+            result_distances[short], result_indices[short] = self.brute_nbrs.kneighbors(X[short],
+                                                                                         n_neighbors=n_neighbors)
+        return result_distances, result_indices
+
+
+def _project(points, directions, nodes, max_elements=2 ** 20):
+    # dot product of every point with the direction of its node, in chunks of rows
+    chunk = max(1, max_elements // max(1, points.shape[1]))
+    projections = np.empty(len(points))
+    for start in range(0, len(points), chunk):
+        stop = start + chunk
+        projections[start:stop] = np.einsum('ij,ij->i', points[start:stop], directions[nodes[start:stop]])
+    return projections
+
+
+def _candidate_distances(points, data, candidates, max_elements=2 ** 22):
+    # euclidean distances of every point to the data points of its candidates row, in chunks of rows
+    chunk = max(1, max_elements // max(1, candidates.shape[1] * data.shape[1]))
+    distances = np.empty(candidates.shape)
+    for start in range(0, len(points), chunk):
+        stop = start + chunk
+        differences = data[candidates[start:stop]] - points[start:stop, np.newaxis, :]
+        distances[start:stop] = np.sqrt(np.einsum('ijk,ijk->ij', differences, differences))
+    return distances
+
+
+def save_neighbors(nbrs, directory):
+    """Saves a fitted neighbors model to .npy files and an index.json in directory, without the data it was
+    fitted on (load_neighbors takes it back). The trees of NearestNeighbors and of RPForestNeighbors are saved
+    as their arrays, other models are fitted again by load_neighbors.
+    """
+    os.makedirs(directory, exist_ok=True)
+    index = {"model": "other", "sklearn": sklearn.__version__}
+    if isinstance(nbrs, NearestNeighbors):
+        index.update(model="nearest_neighbors", algorithm=nbrs._fit_method)
+        if nbrs._tree is not None:
+            state = nbrs._tree.__getstate__()
+            for name, array in zip(("idx_array", "node_data", "node_bounds"), state[1:4]):
+                np.save(os.path.join(directory, name + ".npy"), array)
+            index["tree_counts"] = [int(count) for count in state[4:11]]
+    elif isinstance(nbrs, RPForestNeighbors):
+        index.update(model="rp_forest", n_trees=int(nbrs.n_trees), leaf_size=int(nbrs.leaf_size))
+        # the split directions and thresholds of every tree in heap order, the leaves padded with -1
+        width = max(members.shape[1] for _, _, members in nbrs.trees)
+        directions = np.stack([np.concatenate(tree_directions) if len(tree_directions) > 0 else
+                               np.zeros((0, nbrs.data.shape[1])) for tree_directions, _, _ in nbrs.trees])
+        thresholds = np.stack([np.concatenate(tree_thresholds) if len(tree_thresholds) > 0 else np.zeros(0)
+                               for _, tree_thresholds, _ in nbrs.trees])
+        members = np.stack([np.pad(members, ((0, 0), (0, width - members.shape[1])), constant_values=-1)
+                            for _, _, members in nbrs.trees])
+        np.save(os.path.join(directory, "directions.npy"), directions)
+        np.save(os.path.join(directory, "thresholds.npy"), thresholds)
+        np.save(os.path.join(directory, "members.npy"), members)
+    with open(os.path.join(directory, "index.json"), "w") as handle:
+        json.dump(index, handle)
+
+
+def load_neighbors(directory, data, mmap_mode="r", n_jobs=None, backend="exact"):
+    """Loads a neighbors model saved by save_neighbors, fitted on data. The saved arrays are memory-mapped
+    with mmap_mode. The sklearn trees are only loaded by the sklearn version which saved them and are fitted
+    again by other versions, models of other types are fitted again with backend (a make_neighbors backend).
+    """
+    with open(os.path.join(directory, "index.json")) as handle:
+        index = json.load(handle)
+
+    def load(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode)
+
+    if index["model"] == "nearest_neighbors":
+        if "tree_counts" not in index or index["sklearn"] != sklearn.__version__:
+            return NearestNeighbors(algorithm=index["algorithm"], n_jobs=n_jobs).fit(data)
+        tree_class = KDTree if index["algorithm"] == "kd_tree" else BallTree
+        # the distance metric and the sample weights of the state are those of a tree of the same version
+        state = list(tree_class(data[:1]).__getstate__())
+        state[:4] = [np.asarray(data), load("idx_array"), load("node_data"), load("node_bounds")]
+        state[4:11] = index["tree_counts"]
+        tree = tree_class.__new__(tree_class)
+        tree.__setstate__(tuple(state))
+        # a brute force fit only validates the data, the queries then run on the loaded tree
+        nbrs = NearestNeighbors(algorithm="brute", n_jobs=n_jobs).fit(data)
+        nbrs._fit_method = index["algorithm"]
+        nbrs._tree = tree
+        return nbrs
+
+    if index["model"] == "rp_forest":
+        nbrs = RPForestNeighbors(n_trees=index["n_trees"], leaf_size=index["leaf_size"])
+        nbrs.data = np.asarray(data)
+        nbrs.data_norms = np.einsum('ij,ij->i', nbrs.data, nbrs.data)
+        nbrs.brute_nbrs = None
+        directions = load("directions")
+        thresholds = load("thresholds")
+        members = load("members")
+        levels = [(2 ** level - 1, 2 ** (level + 1) - 1) for level in range(int(np.log2(thresholds.shape[1] + 1)))]
+        nbrs.trees = [([directions[tree, start:stop] for start, stop in levels],
+                       [thresholds[tree, start:stop] for start, stop in levels], members[tree])
+                      for tree in range(len(members))]
+        return nbrs
+
+    return make_neighbors(backend, n_jobs).fit(data)
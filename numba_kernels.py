@@ -0,0 +1,87 @@
+import warnings
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+
+def resolve_backend(backend):
+    """Returns the backend to run with: "numba" when it is asked for and numba is installed, else "numpy"."""
+    if backend not in ("numpy", "numba"):
+        raise ValueError("Unknown backend: %s" % backend)
+    if backend == "numba" and not NUMBA_AVAILABLE:
+        warnings.warn("numba is not installed, falling back to the numpy backend")
+        return "numpy"
+    return backend
+
+
+def _jit(func):
+    # without numba the kernels stay plain python functions, the numpy backend doesn't call them
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True)(func)
+
+
+@_jit
+def first_neighbors_kernel(indices, distances, radii, candidates, link_indices, link_distances):
+    """Fills the first neighbor of every row which is set in candidates and lies within the radius of the row
+    (-1 if there is none). Returns a mask of the rows which were scanned up to their last neighbor.
+    """
+    rows_count, width = indices.shape
+    exhausted = np.zeros(rows_count, dtype=np.bool_)
+    for i in range(rows_count):
+        link_indices[i] = -1
+        link_distances[i] = -1.0
+        exhausted[i] = True
+        for j in range(width):
+            if distances[i, j] > radii[i]:
+                exhausted[i] = False
+                break
+            if candidates[indices[i, j]] != 0:
+                link_indices[i] = indices[i, j]
+                link_distances[i] = distances[i, j]
+                exhausted[i] = False
+                break
+    return exhausted
+
+
+@_jit
+def exp_local_scaling_rknn_kernel(distances, indices, k, rows_count):
+    """rknn values of the exp local scaling transform, accumulated in the same order as the numpy backend."""
+    rknn_values = np.zeros(rows_count)
+    scale_index = min(k, distances.shape[1] - 1)
+    for i in range(distances.shape[0]):
+        local_sigma = distances[i, scale_index]
+        for j in range(distances.shape[1]):
+            dist = distances[i, j]
+            rknn_values[indices[i, j]] += np.exp(-(dist * dist) / (local_sigma * local_sigma))
+    return rknn_values
+
+
+@_jit
+def union_pairs_kernel(parent, p, q):
+    """Unions the pairs (p[i], q[i]) one by one in the parent array of a union find, hooking the larger root
+    under the smaller one (with path halving). Returns the number of sets which were merged.
+    """
+    merges = 0
+    for e in range(len(p)):
+        i = p[e]
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        j = q[e]
+        while parent[j] != j:
+            parent[j] = parent[parent[j]]
+            j = parent[j]
+        if i == j:
+            continue
+        if i < j:
+            parent[j] = i
+        else:
+            parent[i] = j
+        merges += 1
+    return merges
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from time import perf_counter
+import json
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes (None where it isn't available)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Profiler:
+    """Per stage timings of a run.
+
+    stage(name, **counts) records the stage which ended now, it started when the previous stage ended (or when
+    the profiler was created). Every record holds the stage name, the current iteration (None outside of
+    iterations), its start and duration in seconds, the peak RSS of the process so far and the given counts.
+    A disabled profiler records nothing, so the stages of a run can always report to one.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.iteration = None
+        self.start_time = perf_counter()
+        self.last_time = self.start_time
+
+    def stage(self, name, **counts):
+        if not self.enabled:
+            return
+        now = perf_counter()
+        record = OrderedDict([
+            ("stage", name)
+            , ("iteration", self.iteration)
+            , ("start", self.last_time - self.start_time)
+            , ("duration", now - self.last_time)
+            , ("peak_rss", peak_rss())
+        ])
+        record.update(counts)
+        self.records.append(record)
+        self.last_time = now
+
+    def totals(self):
+        """Total duration of every stage over all the iterations, in the order the stages first ran."""
+        totals = OrderedDict()
+        for record in self.records:
+            totals[record["stage"]] = totals.get(record["stage"], 0) + record["duration"]
+        return totals
+
+    def to_json(self, file_path):
+        with open(file_path, "w") as handle:
+            json.dump({"stages": self.records, "totals": self.totals()}, handle, indent=1)
+
+    def to_chrome_trace(self, file_path):
+        """Saves the stages as complete events of the Chrome trace event format (chrome://tracing, Perfetto)."""
+        events = []
+        for record in self.records:
+            args = OrderedDict((key, value) for key, value in record.items()
+                               if key not in ("stage", "start", "duration"))
+            events.append(OrderedDict([
+                ("name", record["stage"])
+                , ("ph", "X")
+                , ("ts", record["start"] * 1e6)
+                , ("dur", record["duration"] * 1e6)
+                , ("pid", 0)
+                , ("tid", 0)
+                , ("args", args)
+            ]))
+        with open(file_path, "w") as handle:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, handle)
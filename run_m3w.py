@@ -1,6 +1,7 @@
 import argparse
 import numpy as np
 from M3W import border_tools as bt, BorderPeel, clustering_tools as ct
+from M3W.neighbors import NeighborCache, RPForestNeighbors
 
 from sklearn.decomposition import PCA
 from sklearn.metrics import adjusted_mutual_info_score
@@ -8,8 +9,8 @@ from sklearn.metrics import adjusted_rand_score
 from sklearn.manifold import SpectralEmbedding
 
 parser = argparse.ArgumentParser(description='Multistep Three-way Clustering')
-parser.add_argument('--input', type=str, metavar='<file path>', help='Path to comma separated input file',
-                    required=True)
+parser.add_argument('--input', type=str, metavar='<file path>',
+                    help='Path to comma separated input file, or to an .npy file which is memory-mapped', required=True)
 parser.add_argument('--output', type=str, metavar='<file path>', help='Path to output file', required=True)
 parser.add_argument("--no-labels", help="Specify that input file has no ground truth labels", action="store_true")
 parser.add_argument('--pca', type=int, metavar='<dimension>',
@@ -18,12 +19,34 @@ parser.add_argument('--pca', type=int, metavar='<dimension>',
 parser.add_argument('--spectral', type=int, metavar='<dimension>',
                     help='Perform sepctral embdding to the given dimension before running the clustering (If comibined with PCA, PCA is performed first)',
                     required=False)
+parser.add_argument('--n-jobs', type=int, metavar='<jobs>', default=None,
+                    help='Number of parallel jobs (-1 for all the cores)', required=False)
+parser.add_argument('--float32', action='store_true', help='Load the input data as float32')
+parser.add_argument('--neighbors', type=str, choices=['exact', 'rp_forest'], default='exact',
+                    help='Nearest neighbors search: exact, or approximate with a random projection forest '
+                         '(faster on high dimensional data)')
+parser.add_argument('--rp-trees', type=int, metavar='<trees>', default=16,
+                    help='Number of random projection trees (higher recall, slower)')
+parser.add_argument('--rp-leaf-size', type=int, metavar='<size>', default=64,
+                    help='Leaf size of the random projection trees (higher recall, slower)')
+parser.add_argument('--output-format', type=str, choices=['csv', 'npy', 'bin'], default='csv',
+                    help='Format of the output file: csv lines, .npy array or raw little endian int32 values')
+parser.add_argument("--memberships", action="store_true",
+                    help="Write all the clusters of each point (three-way memberships) instead of its final label")
+parser.add_argument('--profile', type=str, metavar='<file path>', default=None,
+                    help='Save the per stage timings of the clustering (a .json file, or a Chrome trace for .trace.json)')
 args = parser.parse_args()
 output_file_path = args.output
 input_file_path = args.input
 input_has_labels = not args.no_labels
 pca_dim = args.pca
 spectral_dim = args.spectral
+output_format = args.output_format
+write_memberships = args.memberships
+n_jobs = args.n_jobs
+neighbors_backend = args.neighbors
+if neighbors_backend == 'rp_forest':
+    neighbors_backend = RPForestNeighbors(n_trees=args.rp_trees, leaf_size=args.rp_leaf_size)
 
 debug_output_dir = None
 
@@ -39,7 +62,8 @@ border_precentile = 0.1
 mean_border_eps = 0.15  # 0.15
 stopping_precentile = 0.01
 
-data, labels = ct.read_data(input_file_path, has_labels=input_has_labels)
+data, labels = ct.read_data(input_file_path, has_labels=input_has_labels,
+                            dtype=np.float32 if args.float32 else None)
 
 min_cluster_size = 2
 
@@ -64,7 +88,9 @@ if spectral_dim is not None:
 
 print("Running Multistep Three-way Clustering on: %s" % input_file_path)
 print("*" * 60)
-lambda_estimate = bt.estimate_lambda(embeddings, k)
+# the neighbors of the data are computed once, for the lambda estimation and for the peeling
+nbrs_cache = NeighborCache(embeddings, 2 * k, n_jobs=n_jobs, backend=neighbors_backend)
+lambda_estimate = bt.estimate_lambda(embeddings, k, nbrs_cache=nbrs_cache)
 bp = BorderPeel.BorderPeel(
     mean_border_eps=mean_border_eps
     , max_iterations=T
@@ -79,34 +105,38 @@ bp = BorderPeel.BorderPeel(
     , stopping_precentile=stopping_precentile
     , core_points_threshold=alpha
     , dvalue_threshold=beta
+    , membership_format="csr"
+    , n_jobs=n_jobs
+    , neighbors_backend=neighbors_backend
+    , profile=args.profile is not None
 )
 
-pred_membership = bp.fit_predict(embeddings)
+pred_membership = bp.fit_predict(embeddings, nbrs_cache=nbrs_cache)
 clusters_count = pred_membership.shape[0]
 
 print("*" * 60)
 print("Found %d clusters" % clusters_count)
 print("*" * 60)
 
-clusters = []
-nonzero_indices = np.nonzero(pred_membership)
-nonzero_indices_rows = nonzero_indices[0]
-nonzero_indices_cols = nonzero_indices[1]
-
-with open(output_file_path, "w") as handle:
-    for col in range(pred_membership.shape[1]):
-        if col in nonzero_indices_cols:
-            indices = nonzero_indices_cols == col
-            clus = nonzero_indices_rows[indices]
-        else:
-            clus = np.array([-1])  # outliers
-        clusters.append(np.amax(clus))
-        # handle.write("%s\n" % ','.join(str(c) for c in clus)) # 输出所有标签
-        handle.write("%s\n" % str(np.amax(clus)))  # 输出最终标签
+if write_memberships:
+    membership_clusters, membership_points = bt.membership_entries(pred_membership)
+    ct.save_memberships(output_file_path, membership_clusters, membership_points, pred_membership.shape[1],
+                        output_format=output_format)  # 输出所有标签
+else:
+    clusters = bt.membership_to_labels(pred_membership)
+    ct.save_labels(output_file_path, clusters, output_format=output_format)  # 输出最终标签
 
 print("Saved cluster results to %s" % output_file_path)
 print("*" * 60)
 
+if args.profile is not None:
+    if args.profile.endswith(".trace.json"):
+        bp.profile_.to_chrome_trace(args.profile)
+    else:
+        bp.profile_.to_json(args.profile)
+    print("Saved the stage timings to %s" % args.profile)
+    print("*" * 60)
+
 # if input_has_labels:
 # print("ARI: %0.3f" % adjusted_rand_score(clusters, labels))
 # print("AMI: %0.3f" % adjusted_mutual_info_score(clusters, labels))
@@ -0,0 +1,180 @@
+import argparse
+import contextlib
+import csv
+import glob
+import io
+import os
+import signal
+from multiprocessing import Pool
+from time import time
+from M3W import border_tools as bt, BorderPeel, clustering_tools as ct
+from M3W.neighbors import NeighborCache
+
+parser = argparse.ArgumentParser(description='Multistep Three-way Clustering of many input files')
+parser.add_argument('--inputs', type=str, metavar='<glob>', nargs='*', default=[],
+                    help='Input files or glob patterns (comma separated or .npy files, as in run_m3w.py)')
+parser.add_argument('--manifest', type=str, metavar='<file path>',
+                    help='File listing an input file path per line', required=False)
+parser.add_argument('--output-dir', type=str, metavar='<dir path>',
+                    help='Directory of the output files, laid out as the input files under their common directory',
+                    required=True)
+parser.add_argument("--no-labels", help="Specify that input files have no ground truth labels", action="store_true")
+parser.add_argument('--workers', type=int, metavar='<processes>', default=None,
+                    help='Number of worker processes (all the cores by default)')
+parser.add_argument('--timeout', type=float, metavar='<seconds>', default=None,
+                    help='Time limit of the clustering of a single file (native sklearn/NumPy calls are only '
+                         'interrupted once they return)')
+parser.add_argument('--output-format', type=str, choices=['csv', 'npy', 'bin'], default='csv',
+                    help='Format of the output files: csv lines, .npy array or raw little endian int32 values')
+parser.add_argument("--memberships", action="store_true",
+                    help="Write all the clusters of each point (three-way memberships) instead of its final label")
+
+# Parameters used for border peeling
+k = 8
+C = 1.6
+T = 3
+# Parameters used for three-way clustering
+alpha = 0.6
+beta = 0
+# default values
+border_precentile = 0.1
+mean_border_eps = 0.15  # 0.15
+stopping_precentile = 0.01
+min_cluster_size = 2
+
+
+class FileTimeout(BaseException):
+    # not an Exception, so the broad except clauses of the clustering code don't swallow it
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise FileTimeout()
+
+
+def cluster_file(task):
+    """Clusters a single input file in a worker process and writes its output file, returns its summary row:
+    (input, output, points, clusters, seconds, status).
+    """
+    input_file_path, output_file_path, has_labels, output_format, write_memberships, timeout = task
+    points_count = clusters_count = -1
+    start = time()
+    # the alarm interrupts the file once its time is up (when the worker gets back to python code)
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        data, labels = ct.read_data(input_file_path, has_labels=has_labels)
+        points_count = len(data)
+        with contextlib.redirect_stdout(io.StringIO()):
+            nbrs_cache = NeighborCache(data, 2 * k)
+            lambda_estimate = bt.estimate_lambda(data, k, nbrs_cache=nbrs_cache)
+            bp = BorderPeel.BorderPeel(
+                mean_border_eps=mean_border_eps
+                , max_iterations=T
+                , k=k
+                , plot_debug_output_dir=None
+                , min_cluster_size=min_cluster_size
+                , dist_threshold=lambda_estimate
+                , convergence_constant=0
+                , link_dist_expansion_factor=C
+                , verbose=False
+                , border_precentile=border_precentile
+                , stopping_precentile=stopping_precentile
+                , core_points_threshold=alpha
+                , dvalue_threshold=beta
+                , membership_format="csr"
+            )
+            pred_membership = bp.fit_predict(data, nbrs_cache=nbrs_cache)
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        clusters_count = pred_membership.shape[0]
+
+        if write_memberships:
+            membership_clusters, membership_points = bt.membership_entries(pred_membership)
+            ct.save_memberships(output_file_path, membership_clusters, membership_points, pred_membership.shape[1],
+                                output_format=output_format)
+        else:
+            ct.save_labels(output_file_path, bt.membership_to_labels(pred_membership), output_format=output_format)
+        status = "ok"
+    except FileTimeout:
+        status = "timeout"
+    except Exception as err:
+        status = "error: %s" % str(err).replace("\n", " ")
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return input_file_path, output_file_path, points_count, clusters_count, time() - start, status
+
+
+def input_files(patterns, manifest):
+    """Input file paths of the glob patterns and of the manifest lines (empty lines and # comments are skipped)."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if len(matches) > 0 else [pattern])
+    if manifest is not None:
+        with open(manifest) as handle:
+            paths.extend(line.strip() for line in handle if line.strip() and not line.startswith("#"))
+    return paths
+
+
+def output_paths(paths, output_dir, output_format):
+    """Output file path of every input file: its path relative to the common directory of the inputs, under
+    output_dir and with the output format extension. Raises ValueError when two inputs get the same output
+    file, or when one would overwrite the summary.
+    """
+    input_dirs = [os.path.dirname(os.path.abspath(path)) for path in paths]
+    root = os.path.commonpath(input_dirs) if len(paths) > 0 else ""
+    outputs = []
+    taken = {os.path.normcase(os.path.join(output_dir, "summary.csv")): "the summary"}
+    for path in paths:
+        name = os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0]
+        output_file_path = os.path.join(output_dir, "%s.%s" % (name, output_format))
+        key = os.path.normcase(os.path.normpath(output_file_path))
+        if key in taken:
+            raise ValueError("%s and %s have the same output file %s" % (path, taken[key], output_file_path))
+        taken[key] = path
+        outputs.append(output_file_path)
+    return outputs
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    paths = input_files(args.inputs, args.manifest)
+    if len(paths) == 0:
+        print("No input files")
+        exit(1)
+
+    try:
+        output_file_paths = output_paths(paths, args.output_dir, args.output_format)
+    except ValueError as err:
+        print(err)
+        exit(1)
+
+    tasks = []
+    for path, output_file_path in zip(paths, output_file_paths):
+        os.makedirs(os.path.dirname(output_file_path) or ".", exist_ok=True)
+        tasks.append((path, output_file_path, not args.no_labels, args.output_format, args.memberships,
+                      args.timeout))
+
+    print("Running Multistep Three-way Clustering on %d files" % len(tasks))
+    print("*" * 60)
+    start = time()
+    with Pool(args.workers) as pool:
+        summary = list(pool.imap(cluster_file, tasks, chunksize=1))
+
+    summary_file_path = os.path.join(args.output_dir, "summary.csv")
+    with open(summary_file_path, "w", newline="") as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["input", "output", "points", "clusters", "seconds", "status"])
+        for row in summary:
+            writer.writerow(row[:4] + ("%.3f" % row[4], row[5]))
+
+    print("%-40s %8s %8s %9s  %s" % ("input", "points", "clusters", "seconds", "status"))
+    for input_file_path, _, points_count, clusters_count, seconds, status in summary:
+        print("%-40s %8d %8d %9.3f  %s" % (input_file_path[-40:], points_count, clusters_count, seconds, status))
+    print("*" * 60)
+    failed = sum(1 for row in summary if row[-1] != "ok")
+    print("Clustered %d files in %.1f seconds, %d failed" % (len(summary) - failed, time() - start, failed))
+    print("Saved the summary to %s" % summary_file_path)
@@ -0,0 +1,65 @@
+from M3W.BorderPeel import BorderPeel
+from joblib import Parallel, delayed
+import itertools
+
+# parameters of BorderPeel which only affect its three-way assignment stage
+ASSIGNMENT_PARAMS = ("core_points_threshold", "dvalue_threshold", "min_cluster_size", "membership_format")
+
+
+def params_grid(params_range):
+    """The itertools.product of the values of params_range (parameter name -> values) as a list of dicts."""
+    keys = list(params_range)
+    return [dict(zip(keys, values)) for values in itertools.product(*[params_range[key] for key in keys])]
+
+
+def _grid_index(positions, keys, params_range):
+    # position of a combination in the params_grid() of the keys of params_range
+    index = 0
+    for key in keys:
+        index = index * len(params_range[key]) + positions[key]
+    return index
+
+
+def peel_and_assign(X, params, assignment_grid):
+    """Peels X once with BorderPeel(**params) and runs the assignment stage for every assignment parameters
+    dict of assignment_grid, returns the memberships.
+    """
+    bp = BorderPeel(**params)
+    bp.fit_peeling(X)
+    memberships = []
+    for assignment_params in assignment_grid:
+        bp.set_params(**assignment_params)
+        memberships.append(bp.fit_assignment().labels_)
+    return memberships
+
+
+def border_peel_sweep(X, base_params, params_range, n_jobs=None):
+    """Runs BorderPeel on X for every combination of params_range (parameter name -> values) over base_params,
+    returns a list of (params, membership) in the itertools.product order of params_range.
+
+    The peeling and core merge run once per combination of the peeling parameters (all but ASSIGNMENT_PARAMS),
+    and only the assignment stage runs for each of its alpha/beta/min_cluster_size settings. The peeling
+    settings are spread among n_jobs worker processes (joblib semantics).
+    """
+    keys = list(params_range)
+    peeling_keys = [key for key in keys if key not in ASSIGNMENT_PARAMS]
+    assignment_keys = [key for key in keys if key in ASSIGNMENT_PARAMS]
+    assignment_grid = params_grid({key: params_range[key] for key in assignment_keys})
+
+    settings = []
+    for peeling_params in params_grid({key: params_range[key] for key in peeling_keys}):
+        params = dict(base_params)
+        params.update(peeling_params)
+        settings.append(params)
+
+    memberships = Parallel(n_jobs=n_jobs)(delayed(peel_and_assign)(X, params, assignment_grid) for params in settings)
+
+    results = []
+    for values in itertools.product(*[range(len(params_range[key])) for key in keys]):
+        positions = dict(zip(keys, values))
+        params = dict(base_params)
+        params.update({key: params_range[key][positions[key]] for key in keys})
+        peeling_index = _grid_index(positions, peeling_keys, params_range)
+        assignment_index = _grid_index(positions, assignment_keys, params_range)
+        results.append((params, memberships[peeling_index][assignment_index]))
+    return results
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_blobs
+from M3W import border_tools as bt
+from M3W.BorderPeel import BorderPeel
+
+pytest.importorskip("numba")
+
+
+def fit(X, backend, membership_format="dense"):
+    return BorderPeel(k=8, max_iterations=3, mean_border_eps=0.15, verbose=False, min_cluster_size=2,
+                      stopping_precentile=0.01, core_points_threshold=0.6, dvalue_threshold=0,
+                      link_dist_expansion_factor=1.6, dist_threshold=bt.estimate_lambda(X, 8), membership_format=membership_format,
+                      backend=backend).fit(X)
+
+
+@pytest.mark.parametrize("n_features", [2, 8])
+def test_numba_backend_parity(n_features):
+    X, _ = make_blobs(3000, n_features=n_features, centers=6, random_state=0)
+    numpy_bp = fit(X, "numpy")
+    numba_bp = fit(X, "numba")
+
+    assert np.array_equal(numpy_bp.labels_, numba_bp.labels_)
+    assert np.array_equal(numpy_bp.core_points_indices, numba_bp.core_points_indices)
+    assert np.array_equal(numpy_bp.cores_.core_indices, numba_bp.cores_.core_indices)
+    assert np.array_equal(numpy_bp.cores_.core_clusters, numba_bp.cores_.core_clusters)
+    assert np.array_equal(numpy_bp.link_thresholds, numba_bp.link_thresholds)
+    assert numpy_bp.labels_.shape[0] > 1
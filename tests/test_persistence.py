@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from sklearn.datasets import make_blobs
+from M3W import border_tools as bt
+from M3W.BorderPeel import BorderPeel
+
+
+def border_peel(membership_format="csr"):
+    return BorderPeel(k=8, max_iterations=3, mean_border_eps=0.15, verbose=False, min_cluster_size=2,
+                      stopping_precentile=0.01, core_points_threshold=0.6, dvalue_threshold=0,
+                      link_dist_expansion_factor=1.6, dist_threshold=0.5, membership_format=membership_format)
+
+
+def blobs():
+    return make_blobs(5000, centers=[[0, 0], [10, 0], [0, 10], [10, 10], [60, 60]], cluster_std=1, random_state=0)
+
+
+def test_save_load_predict(tmp_path):
+    X, y = blobs()
+    bp = border_peel().fit(X[:4000])
+    bp.save(str(tmp_path))
+    loaded = BorderPeel.load(str(tmp_path))
+    assert (bp.labels_ != loaded.labels_).nnz == 0
+    assert (bp.predict(X[4000:]) != loaded.predict(X[4000:])).nnz == 0
+
+
+def test_partial_fit_save_load_predict(tmp_path):
+    X, y = blobs()
+    fitted = y < 4
+    bp = border_peel().fit(X[fitted])
+    fitted_clusters = bp.labels_.shape[0]
+    # the last blob is a new cluster, away from the fitted points
+    new_points = X[~fitted]
+    bp.partial_fit(new_points[:500])
+    bp.save(str(tmp_path))
+    loaded = BorderPeel.load(str(tmp_path))
+
+    assert (bp.labels_ != loaded.labels_).nnz == 0
+    last_core = loaded.cores_.nbrs.data[len(loaded.cores_.nbrs) - 1:]
+    assert loaded.cores_.nbrs.kneighbors(last_core, 1)[1][0, 0] == len(loaded.cores_.nbrs) - 1
+    predicted = bp.predict(new_points[500:])
+    assert (predicted != loaded.predict(new_points[500:])).nnz == 0
+    # the held out points of the new blob go to the clusters found in its absorbed points
+    assert np.all(bt.membership_to_labels(loaded.predict(new_points[500:])) >= fitted_clusters)
+
+
+def test_save_numpy_scalar_params(tmp_path):
+    X, y = blobs()
+    bp = border_peel()
+    bp.set_params(k=np.int64(6), dvalue_threshold=np.float32(0))
+    bp.fit(X[:4000])
+    bp.save(str(tmp_path))
+    loaded = BorderPeel.load(str(tmp_path))
+    assert loaded.k == 6 and loaded.dvalue_threshold == 0
+    assert (bp.predict(X[4000:]) != loaded.predict(X[4000:])).nnz == 0
+
+
+def test_save_unknown_param(tmp_path):
+    bp = border_peel().fit(blobs()[0][:1000])
+    bp.set_params(plot_debug_output_dir=object())
+    with pytest.raises(ValueError):
+        bp.save(str(tmp_path))
@@ -0,0 +1,80 @@
+from M3W.numba_kernels import union_pairs_kernel
+import numpy as np
+
+
+class UF:
+    """Array backed union find (disjoint set) over the items 0..N-1.
+
+    Unions hook the root with the larger index under the root with the smaller index, so the
+    root of every set is its smallest item. union() and find() accept scalars as well as arrays
+    of items, find_all() returns the roots of all the items using pointer jumping (which also
+    fully compresses the paths). With the "numba" backend unions are done by a compiled sequential loop.
+    """
+
+    def __init__(self, N, backend="numpy"):
+        self._id = np.arange(N)
+        self._count = N
+        self.backend = backend
+
+    def __len__(self):
+        return len(self._id)
+
+    def find(self, p):
+        """Find the set identifier (root) of the item p, or of every item in the array p."""
+        id = self._id
+        roots = id[p]
+        while True:
+            parents = id[roots]
+            if np.array_equal(parents, roots):
+                break
+            roots = parents
+        id[p] = roots  # path compression
+        return roots
+
+    def find_all(self):
+        """Return the roots of all the items."""
+        id = self._id
+        while True:
+            parents = id[id]
+            if np.array_equal(parents, id):
+                break
+            id = parents
+        self._id = id
+        return id.copy()
+
+    def count(self):
+        """Return the number of sets."""
+        return self._count
+
+    def connected(self, p, q):
+        """Check if the items p and q are on the same set or not."""
+        return self.find(p) == self.find(q)
+
+    def union(self, p, q):
+        """Combine the sets containing p and q, p and q can be arrays of pairs to combine."""
+        p = np.atleast_1d(p)
+        q = np.atleast_1d(q)
+        if self.backend == "numba":
+            self._count -= union_pairs_kernel(self._id, p.astype(self._id.dtype), q.astype(self._id.dtype))
+            return
+
+        while len(p) > 0:
+            i = self.find(p)
+            j = self.find(q)
+            not_connected = i != j
+            p, q, i, j = p[not_connected], q[not_connected], i[not_connected], j[not_connected]
+            if len(p) == 0:
+                break
+
+            # several pairs may hook the same root in one round, only the smallest hook is kept
+            # and the remaining pairs are handled in the next round
+            high = np.maximum(i, j)
+            np.minimum.at(self._id, high, np.minimum(i, j))
+            self._count -= len(np.unique(high))
+
+    def components(self):
+        """Return the sets as arrays of items, ordered by their smallest item."""
+        roots = self.find_all()
+        order = np.argsort(roots, kind='stable')
+        boundaries = np.flatnonzero(np.diff(roots[order])) + 1
+        return np.split(order, boundaries)